@@ -0,0 +1,205 @@
+"""
+Sample Materials, provided under license.
+Licensed Materials - Property of IBM
+© Copyright IBM Corp. 2019. All Rights Reserved.
+US Government Users Restricted Rights - Use, duplication or disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+"""
+
+# benchmark for the AttritionPrep data prep
+# generates a synthetic customer history with the same columns as CUSTOMER_HISTORY_VIEW, times each prep stage
+# and records its peak memory, then writes the results to a json file so that they can be compared between releases
+# e.g. python attrition_benchmark.py --customers 50000 --months 36 --attrition-rate 0.2 --output benchmark_results.json
+
+import pandas as pd
+import numpy as np
+import datetime
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import re
+import tempfile
+import time
+import tracemalloc
+
+from attrition_prep import AttritionPrep
+
+def view_columns(sql_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CUSTOMER_HISTORY_VIEW.sql')):
+    # the column names of CUSTOMER_HISTORY_VIEW, taken from the aliases in the view definition
+    with open(sql_path, 'r', encoding='utf-8') as f:
+        return re.findall(r'\bas\s+([A-Z][A-Z0-9_]*)', f.read())
+
+def generate_customer_history(n_customers=1000, n_months=36, attrition_rate=0.2, seed=0, start_date='2015-10-01', extra_columns=0):
+    # generates a customer history with a record for each customer for each month they were a customer
+    # attrition_rate is the share of customers who attrite in their last month, either by becoming inactive
+    # or by their funds under management dropping by 90%
+    # extra_columns adds that many more numeric columns from CUSTOMER_HISTORY_VIEW that the prep does not use
+    rng = np.random.RandomState(seed)
+    month_starts = pd.date_range(start_date, periods=n_months, freq='MS')
+
+    # every customer has at least 3 months of data, starting somewhere in the first half of the period
+    first_month = rng.randint(0, max(n_months // 2, 1), n_customers)
+    n_customer_months = rng.randint(3, n_months - first_month + 1)
+    n_rows = n_customer_months.sum()
+    customer_ids = np.arange(1000, 1000 + n_customers)
+
+    row_customer = np.repeat(np.arange(n_customers), n_customer_months)
+    row_first = np.repeat(np.cumsum(n_customer_months) - n_customer_months, n_customer_months)
+    row_month = first_month[row_customer] + np.arange(n_rows) - row_first
+    is_last_month = np.arange(n_rows) == np.repeat(np.cumsum(n_customer_months) - 1, n_customer_months)
+
+    df = pd.DataFrame({'CUSTOMER_CUSTOMER_ID' : customer_ids[row_customer]})
+    df['CUSTOMER_SUMMARY_START_DATE'] = month_starts[row_month]
+    df['CUSTOMER_SUMMARY_END_DATE'] = df['CUSTOMER_SUMMARY_START_DATE'] + pd.offsets.MonthEnd(0)
+    df['CUSTOMER_EFFECTIVE_DATE'] = df['CUSTOMER_SUMMARY_START_DATE'].dt.strftime('%Y-%m-%d')
+
+    # join date is up to ~5 years before the first month of data, missing for some customers
+    joined = month_starts[first_month] - pd.to_timedelta(rng.randint(0, 2000, n_customers), unit='D')
+    joined = pd.Series(joined).where(rng.rand(n_customers) > 0.2)
+    df['CUSTOMER_RELATIONSHIP_START_DATE'] = joined.values[row_customer]
+    df.loc[rng.rand(n_rows) < 0.1, 'CUSTOMER_RELATIONSHIP_START_DATE'] = pd.NaT
+
+    # funds under management follow a random walk for each customer
+    growth = np.log(rng.uniform(0.9, 1.12, n_rows))
+    growth[row_first == np.arange(n_rows)] = 0
+    cum_growth = np.cumsum(growth)
+    cum_growth -= cum_growth[row_first]
+    funds = rng.uniform(1e4, 1e6, n_customers)[row_customer] * np.exp(cum_growth)
+
+    attrited = rng.rand(n_customers) < attrition_rate
+    inactive = rng.rand(n_customers) < 0.5
+    attrite_row = is_last_month & attrited[row_customer]
+    funds[attrite_row & ~inactive[row_customer]] *= 0.1
+    df['CUSTOMER_STATUS'] = np.where(attrite_row & inactive[row_customer], 'Inactive', 'Active')
+    df['CUSTOMER_SUMMARY_FUNDS_UNDER_MANAGEMENT'] = funds
+
+    # customer attributes that don't change from month to month
+    categories = {'CUSTOMER_AGE_RANGE' : ['20 to 30', '30 to 40', '40 to 50', '50 to 60', '60 to 70'],
+                  'CUSTOMER_GENDER' : ['Male', 'Female'],
+                  'CUSTOMER_EDUCATION_LEVEL' : ['High School', 'College', 'Masters', 'Doctorate'],
+                  'CUSTOMER_URBAN_CODE' : ['Urban', 'Suburban', 'Rural'],
+                  'CUSTOMER_MARKET_GROUP' : ['USA Indiana', 'USA Illinois', 'USA Ohio', 'USA Michigan'],
+                  'CUSTOMER_EMPLOYMENT_STATUS' : ['Employed', 'Retired', 'Unemployed'],
+                  'CUSTOMER_MARITAL_STATUS' : ['Married', 'Single', 'Divorced', 'Widowed']}
+    for col, values in categories.items():
+        df[col] = np.array(values)[rng.randint(len(values), size=n_customers)][row_customer]
+    df['CUSTOMER_NUMBER_OF_DEPENDENT_ADULTS'] = rng.randint(0, 3, n_customers)[row_customer]
+    df['CUSTOMER_NUMBER_OF_DEPENDENT_CHILDREN'] = rng.randint(0, 4, n_customers)[row_customer]
+    df['CUSTOMER_ANNUAL_INCOME'] = rng.uniform(2e4, 3e5, n_customers)[row_customer]
+    df['CUSTOMER_INTERNET_BANKING_INDICATOR'] = rng.randint(0, 2, n_customers)[row_customer]
+    df['CUSTOMER_FAMILY_SIZE'] = rng.randint(1, 6, n_customers)[row_customer]
+
+    # monthly summary values
+    df['CUSTOMER_SUMMARY_ASSETS'] = rng.uniform(1e3, 1e6, n_rows)
+    df['CUSTOMER_SUMMARY_TOTAL_AMOUNT_OF_DEPOSITS'] = rng.uniform(100, 5000, n_rows)
+    df['CUSTOMER_SUMMARY_TOTAL_AMOUNT_OF_MARKET_CHANGE'] = rng.uniform(-500, 500, n_rows)
+    df['CUSTOMER_SUMMARY_NUMBER_OF_TRANSACTIONS'] = rng.randint(1, 50, n_rows)
+    df['CUSTOMER_SUMMARY_NUMBER_OF_MOBILE_LOGINS'] = rng.randint(1, 30, n_rows)
+    df['CUSTOMER_SUMMARY_NUMBER_OF_LOGINS'] = rng.randint(1, 60, n_rows)
+    df['CUSTOMER_SUMMARY_NUMBER_OF_ACCOUNTS'] = rng.randint(1, 4, n_rows)
+    df['CUSTOMER_SUMMARY_TOTAL_AMOUNT_OF_ALL_FEES'] = rng.uniform(0, 100, n_rows)
+    df['CUSTOMER_SUMMARY_AVERAGE_SENTIMENT_SCORE'] = rng.uniform(0, 5, n_rows)
+    for col in ['NUM_ACCOUNTS_WITH_RISK_TOLERANCE_HIGH', 'NUM_ACCOUNTS_WITH_RISK_TOLERANCE_LOW',
+                'NUM_ACCOUNTS_WITH_RISK_TOLERANCE_MODERATE', 'NUM_ACCOUNTS_WITH_RISK_TOLERANCE_VERY_LOW',
+                'NUM_ACCOUNTS_WITH_INVESTMENT_OBJECTIVE_GROWTH', 'NUM_ACCOUNTS_WITH_INVESTMENT_OBJECTIVE_INCOME',
+                'NUM_ACCOUNTS_WITH_INVESTMENT_OBJECTIVE_PLANNING', 'NUM_ACCOUNTS_WITH_INVESTMENT_OBJECTIVE_SECURE_GROWTH',
+                'NUM_ACCOUNTS_WITH_INVESTMENT_OBJECTIVE_SECURITY']:
+        df[col] = rng.randint(0, 2, n_rows)
+    # the risk tolerance counts are missing when a customer has no accounts with that tolerance
+    df['NUM_ACCOUNTS_WITH_RISK_TOLERANCE_VERY_LOW'] = df['NUM_ACCOUNTS_WITH_RISK_TOLERANCE_VERY_LOW'].where(rng.rand(n_rows) > 0.3)
+
+    if extra_columns > 0:
+        unused_columns = [col for col in view_columns() if col not in df.columns]
+        for col in unused_columns[:extra_columns]:
+            df[col] = rng.uniform(0, 1000, n_rows)
+
+    return df
+
+def profile_stage(func, repeat=1):
+    # runs func repeat times and returns the fastest wall time, then runs it once more under tracemalloc for the peak memory
+    # the prep prints its progress, which isn't wanted in the benchmark output
+    timings = []
+    for i in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = func()
+            timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, {'seconds' : min(timings), 'peak_memory_mb' : peak / 2**20}
+
+def run_benchmark(n_customers=1000, n_months=36, attrition_rate=0.2, seed=0, repeat=1, extra_columns=0,
+                  effective_date_earliest='2016-01-01', effective_date_latest='2018-09-30', effective_date='2018-09-30'):
+    # times prep_data for train and score, and derive_features and data_cleaning on their own
+    # returns a dictionary with the benchmark settings and a result for each stage
+    df_history = generate_customer_history(n_customers, n_months, attrition_rate, seed, extra_columns=extra_columns)
+    results = {'settings' : {'customers' : n_customers, 'months' : n_months, 'attrition_rate' : attrition_rate, 'seed' : seed,
+                             'repeat' : repeat, 'extra_columns' : extra_columns, 'history_rows' : df_history.shape[0],
+                             'history_columns' : df_history.shape[1]},
+               'environment' : {'python' : platform.python_version(), 'pandas' : pd.__version__, 'numpy' : np.__version__,
+                                'platform' : platform.platform()},
+               'created' : datetime.datetime.now().isoformat(),
+               'stages' : {}}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # save the training json to a temporary folder so the benchmark doesn't overwrite the real one
+        user_inputs_path = os.path.join(temp_dir, 'training_user_inputs_and_prepped_column_names.json')
+        train_prep = AttritionPrep('train', effective_date_earliest, effective_date_latest, user_inputs_path=user_inputs_path)
+        score_prep = AttritionPrep('score', effective_date=effective_date, user_inputs_path=user_inputs_path)
+
+        df_prepped, results['stages']['prep_data_train'] = profile_stage(lambda: train_prep.prep_data(df_history.copy(), 'train'), repeat)
+        results['stages']['prep_data_train']['rows_in'] = df_history.shape[0]
+        results['stages']['prep_data_train']['rows_out'] = df_prepped.shape[0]
+
+        df_scored, results['stages']['prep_data_score'] = profile_stage(lambda: score_prep.prep_data(df_history.copy(), 'score'), repeat)
+        results['stages']['prep_data_score']['rows_in'] = df_history.shape[0]
+        results['stages']['prep_data_score']['rows_out'] = df_scored.shape[0]
+
+        # derive_features on the observation window ending at the scoring effective date, for every customer
+        df_window = score_prep.filter_attributes(df_history.copy())
+        df_window = df_window.sort_values(by=[score_prep.granularity_key, score_prep.customer_end_date])
+        df_window = df_window[df_window[score_prep.customer_end_date] <= pd.Timestamp(effective_date)]
+        df_window['OBS_MONTH_MIN_OW'] = (pd.Timestamp(effective_date) + datetime.timedelta(days=1)
+                                         - pd.DateOffset(months=score_prep.observation_window))
+        col_list = [attribute for attribute in score_prep.derive_column_list if attribute in df_window.columns]
+        df_features, results['stages']['derive_features'] = profile_stage(
+            lambda: score_prep.derive_features(df_window, col_list, score_prep.observation_window), repeat)
+        results['stages']['derive_features']['rows_in'] = df_window.shape[0]
+        results['stages']['derive_features']['rows_out'] = df_features.shape[0]
+
+        # data_cleaning on the training data before it is cleaned
+        with contextlib.redirect_stdout(io.StringIO()):
+            df_to_clean = train_prep.prep_customers(df_history.copy(), 'train')
+        df_cleaned, results['stages']['data_cleaning'] = profile_stage(
+            lambda: train_prep.data_cleaning(df_to_clean.copy(), train_prep.cat_threshold, 'train'), repeat)
+        results['stages']['data_cleaning']['rows_in'] = df_to_clean.shape[0]
+        results['stages']['data_cleaning']['rows_out'] = df_cleaned.shape[0]
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the AttritionPrep data prep on a synthetic customer history')
+    parser.add_argument('--customers', type=int, default=1000)
+    parser.add_argument('--months', type=int, default=36)
+    parser.add_argument('--attrition-rate', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='number of timed runs of each stage, the fastest is kept')
+    parser.add_argument('--extra-columns', type=int, default=0, help='unused CUSTOMER_HISTORY_VIEW columns to add to the history')
+    parser.add_argument('--output', default='attrition_benchmark_results.json')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.customers, args.months, args.attrition_rate, args.seed, args.repeat, args.extra_columns)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for stage, stage_results in results['stages'].items():
+        print(stage + ': ' + str(round(stage_results['seconds'], 3)) + 's, peak memory '
+              + str(round(stage_results['peak_memory_mb'], 1)) + 'MB, '
+              + str(stage_results['rows_in']) + ' rows in, ' + str(stage_results['rows_out']) + ' rows out')
@@ -12,8 +12,18 @@ from dateutil.relativedelta import relativedelta
 import sys
 from pandas.api.types import is_string_dtype
 from pandas.api.types import is_numeric_dtype
+from pandas.api.types import is_integer_dtype
 import os
 import json
+import concurrent.futures
+import hashlib
+import logging
+import time
+import tracemalloc
+
+class NoCustomersError(Exception):
+    # raised by the prep when none of the customers are left to prep, e.g. none of them have enough months of data
+    pass
 
 class AttritionPrep():
 
@@ -43,7 +53,8 @@ class AttritionPrep():
                        customer_end_date='CUSTOMER_SUMMARY_END_DATE', customer_start_date='CUSTOMER_SUMMARY_START_DATE',
                        period_attribute='CUSTOMER_TENURE', status_flag_attrition='Inactive', AUM_reduction_threshold=0.75,
                        forecast_horizon=6, observation_window=6, sum_list=["CUSTOMER_SUMMARY_TOTAL_AMOUNT_OF_DEPOSITS",
-                       "CUSTOMER_SUMMARY_TOTAL_AMOUNT_OF_MARKET_CHANGE", "CUSTOMER_SUMMARY_NUMBER_OF_TRANSACTIONS"], cat_threshold=10):
+                       "CUSTOMER_SUMMARY_TOTAL_AMOUNT_OF_MARKET_CHANGE", "CUSTOMER_SUMMARY_NUMBER_OF_TRANSACTIONS"], cat_threshold=10, random_seed=0, prep_transformer=None,
+                       user_inputs_path='/project_data/data_asset/training_user_inputs_and_prepped_column_names.json', stage_observer=None):
 
         self.columns_required = columns_required
         self.feature_attributes = feature_attributes
@@ -66,6 +77,13 @@ class AttritionPrep():
         self.effective_date = effective_date
         self.sum_list = sum_list
         self.cat_threshold = cat_threshold
+        self.random_seed = random_seed
+        # the categories, columns and to_drop_corr list saved by fit_prep_transformer, used when scoring
+        self.prep_transformer = prep_transformer
+        # where the user inputs and prep transformer are saved when training
+        self.user_inputs_path = user_inputs_path
+        # optional function that is called with the wall time, rows in and out and peak memory of each stage of the prep
+        self.stage_observer = stage_observer
 
         # if effective date is a date convert it to a string for consistency
         if self.train_or_score == 'score':
@@ -96,6 +114,85 @@ class AttritionPrep():
         rand_cuttoff_month = (date1.replace(day=1) - relativedelta(months=int(randnumber * multiplier)))
         return rand_cuttoff_month
 
+    # vectorized versions of the month arithmetic above, applied to whole datetime64 columns at once
+    # dates are split into an integer month index (year*12 + month), the day within the month and the time of day
+    # results are the same as relativedelta, including clamping the day to the end of the month
+    def split_months(self, dates):
+        values = np.asarray(dates, dtype='datetime64[ns]')
+        months = values.astype('datetime64[M]')
+        days = values.astype('datetime64[D]')
+        day_of_month = days - months.astype('datetime64[D]')
+        time_of_day = values - days.astype('datetime64[ns]')
+        return months, day_of_month, time_of_day
+
+    def shift_months(self, months, day_of_month, time_of_day, n_months):
+        # move to the target month, then clamp the day to the number of days in that month
+        target = months + np.asarray(n_months, dtype=np.int64)
+        month_length = (target + 1).astype('datetime64[D]') - target.astype('datetime64[D]')
+        day = np.minimum(day_of_month, month_length - np.timedelta64(1, 'D'))
+        return (target.astype('datetime64[D]') + day).astype('datetime64[ns]') + time_of_day
+
+    def vec_add_months(self, dates, n_months):
+        # same as dates + relativedelta(months=n_months) for every row
+        months, day_of_month, time_of_day = self.split_months(dates)
+        shifted = self.shift_months(months, day_of_month, time_of_day, n_months)
+        return pd.Series(shifted, index=getattr(dates, 'index', None))
+
+    def vec_n_months(self, date1, date2):
+        # same as udf_n_months for every row, the number of whole months from date2 to date1
+        months1, _, _ = self.split_months(date1)
+        months2, day_of_month2, time_of_day2 = self.split_months(date2)
+        values1 = np.asarray(date1, dtype='datetime64[ns]')
+        values2 = np.asarray(date2, dtype='datetime64[ns]')
+        month_dif = (months1 - months2).astype(np.int64)
+        # date2 moved forward by month_dif months lands in the same month as date1
+        # step back one month if it overshoots date1 (or forward one if date1 is before date2)
+        candidate = self.shift_months(months2, day_of_month2, time_of_day2, month_dif)
+        month_dif = np.where(values1 >= values2, month_dif - (candidate > values1), month_dif + (values1 > candidate))
+        missing = np.isnat(values1) | np.isnat(values2)
+        if missing.any():
+            month_dif = np.where(missing, np.nan, month_dif)
+        return pd.Series(month_dif, index=getattr(date1, 'index', None))
+
+    def vec_sub_rand_latency(self, date1, randnumber, multiplier):
+        # same as udf_sub_rand_latency for every row
+        months, _, time_of_day = self.split_months(date1)
+        n_months = (np.asarray(randnumber) * np.asarray(multiplier)).astype(np.int64)
+        shifted = self.shift_months(months, np.timedelta64(0, 'D'), time_of_day, -n_months)
+        return pd.Series(shifted, index=getattr(date1, 'index', None))
+
+    # start_stage and end_stage report a named stage of the prep to stage_observer
+    # without an observer they return straight away, so they cost next to nothing
+    # with an observer, memory is traced with tracemalloc during the stage, which makes the stage slower
+    # with n_shards > 1 the observer is called in each worker process, so it has to be picklable e.g. log_stage
+    def start_stage(self, name, df_in):
+        if self.stage_observer is None:
+            return None
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        else:
+            tracemalloc.reset_peak()
+        return (name, df_in.shape[0], started_tracing, tracemalloc.get_traced_memory()[0], time.perf_counter())
+
+    def end_stage(self, stage, df_out):
+        if stage is None:
+            return
+        name, rows_in, started_tracing, memory_start, time_start = stage
+        seconds = time.perf_counter() - time_start
+        peak_memory = tracemalloc.get_traced_memory()[1] - memory_start
+        if started_tracing:
+            tracemalloc.stop()
+        self.stage_observer({'stage' : name, 'seconds' : seconds, 'rows_in' : rows_in,
+                             'rows_out' : None if df_out is None else df_out.shape[0], 'peak_memory_mb' : peak_memory / 2**20})
+
+    # returns a random number in [0, 1) for each customer ID that depends only on the customer ID and random_seed
+    # used instead of np.random so that a customer gets the same cutoff date however the customers are split up or ordered
+    def customer_rand(self, customer_ids):
+        # hash the customer ID, add the seed and hash again so that the seed changes every customer's number
+        hashed = pd.util.hash_array(pd.util.hash_array(np.asarray(customer_ids)) + np.uint64(self.random_seed))
+        return (hashed >> np.uint64(11)).astype('float64') / 2**53
+
     def filter_attributes(self, df):
         # this function takes in a dataframe and filters to include only the columns specified by the user
         
@@ -107,46 +204,117 @@ class AttritionPrep():
         if len(cols_passed_but_not_in_df) > 0:
             print(str(len(cols_passed_but_not_in_df)) + ' columns were passed but are not contained in the data. :' + str(cols_passed_but_not_in_df))
             default_attributes = [col for col in default_attributes if col not in cols_passed_but_not_in_df]
-        df = df[default_attributes]
+        # select with loc so that later steps can fill columns of the new frame in place
+        df = df.loc[:, default_attributes]
         return df
-        
+
+    def history_to_parquet(self, history, parquet_path):
+        # this function writes the customer history to a parquet file that read_history can load quickly
+        # history can be the path to the customer history csv export or a dataframe, e.g. read from CUSTOMER_HISTORY_VIEW
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if isinstance(history, str):
+            history = pd.read_csv(history, parse_dates=[self.date_customer_joined, self.customer_end_date, self.customer_start_date],
+                                  infer_datetime_format=True)
+
+        # sort by month and write one row group for each month
+        # the row group statistics then let the reader skip every month outside of the date range it needs
+        history = history.sort_values(by=[self.customer_end_date, self.granularity_key])
+        table = pa.Table.from_pandas(history, preserve_index=False)
+        months = history[self.customer_end_date].values.astype('datetime64[M]').astype(np.int64)
+        boundaries = list(np.flatnonzero(months[1:] != months[:-1]) + 1)
+
+        with pq.ParquetWriter(parquet_path, table.schema) as writer:
+            for start, end in zip([0] + boundaries, boundaries + [table.num_rows]):
+                writer.write_table(table.slice(start, end - start))
+
+    def read_history(self, parquet_path, train_or_score):
+        # this function reads the customer history from a parquet file written by history_to_parquet
+        # only the columns used by the prep are read, and only the months that prep_data keeps
+        import pyarrow.parquet as pq
+
+        default_attributes = list(set(self.columns_required + self.feature_attributes))
+        file_columns = pq.read_schema(parquet_path).names
+        default_attributes = [col for col in default_attributes if col in file_columns]
+
+        # when training, only months between the earliest and latest effective dates are used
+        # when scoring, the customer's whole history up to the effective date is used to check for attrition
+        if train_or_score == 'train':
+            date_filters = [(self.customer_end_date, '>=', pd.Timestamp(self.effective_date_earliest)),
+                            (self.customer_end_date, '<=', pd.Timestamp(self.effective_date_latest))]
+        elif train_or_score == 'score':
+            date_filters = [(self.customer_end_date, '<=', pd.Timestamp(self.effective_date))]
+        df = self.compact_dtypes(pq.read_table(parquet_path, columns=default_attributes, filters=date_filters).to_pandas())
+
+        # missing join dates are filled from the customer's whole history, not just the months that were read
+        # read the columns needed for that for the customers who are missing a join date and fill them here,
+        # fill_date_customer_joined then has nothing left to do in prep_data
+        if self.date_customer_joined in df.columns and df[self.date_customer_joined].isnull().any():
+            cust_date_cust_joined_missing = df[df[self.date_customer_joined].isnull()][self.granularity_key].unique().tolist()
+            df_dates = pq.read_table(parquet_path, columns=[self.granularity_key, self.date_customer_joined, self.customer_start_date],
+                                     filters=[(self.granularity_key, 'in', cust_date_cust_joined_missing)]).to_pandas()
+            df_dates = self.fill_date_customer_joined(df_dates)
+            df_new_start_date = df_dates.groupby(self.granularity_key)[self.date_customer_joined].min()
+            df[self.date_customer_joined] = df[self.date_customer_joined].fillna(df[self.granularity_key].map(df_new_start_date))
+
+        return df
+
+    def compact_dtypes(self, df):
+        # this function stores the customer history in less memory without changing the prepped data
+        # string attributes, e.g. CUSTOMER_AGE_RANGE and CUSTOMER_STATUS, are stored as categoricals - one code per record
+        # instead of one python string, and integer counts and indicators are stored in the smallest integer type that fits
+        # the customer ID is left as it is, it is used for joining and for each customer's random number
+        for col in df.columns:
+            if col == self.granularity_key:
+                continue
+            if df[col].dtype == object:
+                df[col] = df[col].astype('category')
+            elif is_integer_dtype(df[col]):
+                df[col] = pd.to_numeric(df[col], downcast='integer')
+        return df
+
+    def load_history(self, csv_path, chunksize=100000):
+        # this function reads the customer history csv export (a path or an open file) one chunk at a time and compacts each chunk with compact_dtypes,
+        # so the whole history is never held with python strings. Only the columns used by the prep are read
+        default_attributes = list(set(self.columns_required + self.feature_attributes))
+        chunks = [self.compact_dtypes(df_chunk) for df_chunk in
+                  pd.read_csv(csv_path, usecols=lambda col: col in default_attributes, chunksize=chunksize,
+                              parse_dates=[self.date_customer_joined, self.customer_end_date, self.customer_start_date],
+                              infer_datetime_format=True)]
+        if len(chunks) == 0:
+            return pd.DataFrame()
+
+        # give each categorical column the same categories in every chunk so they stay categorical when concatenated
+        for col in chunks[0].columns:
+            if any(isinstance(df_chunk[col].dtype, pd.CategoricalDtype) for df_chunk in chunks):
+                categories = set()
+                for df_chunk in chunks:
+                    categories.update(df_chunk[col].dropna().unique().tolist())
+                dtype = pd.CategoricalDtype(sorted(categories))
+                for df_chunk in chunks:
+                    df_chunk[col] = df_chunk[col].astype(dtype)
+
+        return pd.concat(chunks, ignore_index=True)
+
     def fill_date_customer_joined(self, df):
         # function to fill in any missing data for customer join date
         # if only some records are missing for the customer and we have the join date in other records use that
         # Otherwise, use the earliest customer summary start date
 
-        nb_cust_date_customer_joined_filled = df[df[self.date_customer_joined].isnull()][self.granularity_key].nunique()
-
-        if nb_cust_date_customer_joined_filled > 0:
-            print('Filling date_customer_joined for ' + str(nb_cust_date_customer_joined_filled) + ' customers')
-            # get a list of the customers who are missing start dates
-            cust_date_cust_joined_missing = list(df[df[self.date_customer_joined].isnull()][self.granularity_key].unique())
-
-            # check to see if any of the start date records for the customer are filled in
-            # use this if it's available
-            df_new_start_date = df[df[self.granularity_key].isin(cust_date_cust_joined_missing)].groupby(self.granularity_key)[self.date_customer_joined].min().reset_index()
-            df_new_start_date = df_new_start_date[df_new_start_date[self.date_customer_joined].notnull()]
-            df_new_start_date.rename(columns={self.date_customer_joined: 'MIN_START_DATE'}, inplace=True)
-            if df_new_start_date.shape[0] > 0:
-                df = df.merge(df_new_start_date, on=self.granularity_key, how='left')
-                df[self.date_customer_joined].fillna(df['MIN_START_DATE'], inplace=True)
-                # since these customers are not now missing start dates, remove them from the list
-                cust_date_cust_joined_missing = list(set(cust_date_cust_joined_missing) - set(df_new_start_date[self.granularity_key].unique()))
-                # drop the min_start_date var
-                df.drop('MIN_START_DATE', axis=1, inplace=True)
-
-            if len(cust_date_cust_joined_missing) > 0:
-                # get the earliest customer summary start date for each customer who is missing a start date
-                df_new_start_date = df[df[self.granularity_key].isin(cust_date_cust_joined_missing)].groupby(self.granularity_key)[self.customer_start_date].min().reset_index()
-                df_new_start_date.rename(columns={self.customer_start_date:'NEW_START_DATE'}, inplace=True)
-                # join back to original df and update 
-                df = df.merge(df_new_start_date, on=self.granularity_key, how='left')
-                df[self.date_customer_joined].fillna(df['NEW_START_DATE'], inplace=True)
-                df.drop('NEW_START_DATE', axis=1, inplace=True)
+        date_customer_joined_missing = df[self.date_customer_joined].isnull()
+
+        if date_customer_joined_missing.any():
+            print('Filling date_customer_joined for ' + str(df.loc[date_customer_joined_missing, self.granularity_key].nunique()) + ' customers')
+            # get the earliest join date and the earliest summary start date of each customer in one grouped pass
+            df_min_dates = df.groupby(self.granularity_key)[[self.date_customer_joined, self.customer_start_date]].transform('min')
+            # the join date from the customer's other records takes precedence over their earliest summary start date
+            new_start_date = df_min_dates[self.date_customer_joined].fillna(df_min_dates[self.customer_start_date])
+            df[self.date_customer_joined] = df[self.date_customer_joined].fillna(new_start_date)
 
         return df
     
-    def define_attrition_monthly(self, df):
+    def define_attrition_monthly(self, df, prev_funds=None):
         
         # defines an attrition flag for each month. If the customer was 'inactive' in the month,
         # or their funds under management dropped by the threshold set or more, 
@@ -158,6 +326,10 @@ class AttritionPrep():
         df = df.sort_values(by=[self.granularity_key, self.customer_end_date])
         # add a new column which is the funds_attribute for the previous row (month in most cases)
         df['AUM_PREV_MONTH'] = df.groupby([self.granularity_key])[self.funds_attribute].shift(1)
+        # prev_funds is the funds_attribute of each customer's record before the first one in df, e.g. kept by a RollingFeatureStore
+        if prev_funds is not None:
+            first_record = ~df[self.granularity_key].duplicated()
+            df.loc[first_record, 'AUM_PREV_MONTH'] = df.loc[first_record, self.granularity_key].map(prev_funds)
         # get the ratio of this months funds vs previous month of data for the customer
         df['RATIO'] = df[self.funds_attribute] / df['AUM_PREV_MONTH']
         df['RATIO'].fillna(9999, inplace=True)
@@ -186,39 +358,44 @@ class AttritionPrep():
         
         return df
 
-    def derive_features(self, df, col_list, observation_window):
+    def derive_features(self, df, col_list, observation_window, df_summary=None, snapshot_key=None):
         # this function computes summary statistics of the customers numerical features over the observation window
         # we calculate average, std, min, max, min max ratio, current vs average for numerical features
+        # returns the latest record in the observation window for each customer with the summary statistics joined to it
+        # df_summary can be passed in when the statistics are already available, e.g. from a RollingFeatureStore
+        # snapshot_key is a column numbering the observation windows when df has more than one per customer (see prep_backtest),
+        # the statistics and latest record are then returned for each customer and window
+        group_keys = [self.granularity_key] if snapshot_key is None else [self.granularity_key, snapshot_key]
 
         # filter to only include records that are within the observation window
         df = df[df[self.customer_end_date]>=df['OBS_MONTH_MIN_OW']].copy()
 
-        # group by customer ID and calculate the summary stats
-        # first here is the first month in observation window
-        df_summary = df.groupby(self.granularity_key)[col_list].agg(['mean', 'std', 'min', 'max', 'last', 'first']).reset_index()
-        # rename the columns
-        df_summary.columns = df_summary.columns.map('_'.join)
-        # the above renames the customer id column, change it back to original
-        df_summary.rename(columns={self.granularity_key + '_': self.granularity_key}, inplace=True)
-        
-        for col in col_list:
-            df_summary[col + '_max_min_ratio'] = df_summary[col + '_max'] / df_summary[col + '_min']
-            df_summary[col + '_std_norm'] = df_summary[col + '_std'] / df_summary[col + '_mean']
-            df_summary[col + '_current_vs_mean'] = df_summary[col + '_last'] / df_summary[col + '_mean']
-            df_summary[col + '_current_vs_' + str(observation_window) + '_months_ago'] = df_summary[col + '_last'] / df_summary[col + '_first']
+        if df_summary is None:
+            # group by customer ID and calculate the summary stats
+            # first here is the first month in observation window
+            df_summary = df.groupby(group_keys)[col_list].agg(['mean', 'std', 'min', 'max', 'last', 'first']).reset_index()
+            # rename the columns
+            df_summary.columns = df_summary.columns.map('_'.join)
+            # the above renames the customer id column, change it back to original
+            df_summary.rename(columns={key + '_': key for key in group_keys}, inplace=True)
+            
+            df_summary = self.add_window_ratios(df_summary, col_list, observation_window)
 
-        col_sum_list = [attribute for attribute in self.sum_list if attribute in col_list]
+            col_sum_list = [attribute for attribute in self.sum_list if attribute in col_list]
 
-        if len(col_sum_list) > 0:
-            df_for_summing = df.groupby(self.granularity_key)[col_sum_list].sum().reset_index()
-            for col in df_for_summing:
-                if col not in [self.granularity_key]:
-                    df_for_summing.rename(columns={col: col + '_sum'}, inplace=True)
+            if len(col_sum_list) > 0:
+                df_for_summing = df.groupby(group_keys)[col_sum_list].sum().reset_index()
+                for col in df_for_summing:
+                    if col not in group_keys:
+                        df_for_summing.rename(columns={col: col + '_sum'}, inplace=True)
 
-            df_summary = df_summary.merge(df_for_summing, on=self.granularity_key, how='left')
+                df_summary = df_summary.merge(df_for_summing, on=group_keys, how='left')
 
-        # we join back to the df that has a record for each month in the observation window for each customer
-        df = df.merge(df_summary, on=self.granularity_key, how='inner')
+        # keep only the latest record in the observation window for each customer
+        # use last here in the event that there is more than 1 record for last date
+        # this is done before joining the summary stats so that they are only joined to one record per customer
+        df = df.groupby(group_keys).last().reset_index()
+        df = df.merge(df_summary, on=group_keys, how='inner')
 
         # remove the variables for first and last record
         for col in col_list:    
@@ -227,64 +404,514 @@ class AttritionPrep():
             df.drop(col + '_first', axis=1, inplace=True)
         
         return df
+
+    def add_window_ratios(self, df_summary, col_list, observation_window):
+        # add the ratio features computed from the mean, std, min, max, last and first of each column
+        for col in col_list:
+            df_summary[col + '_max_min_ratio'] = df_summary[col + '_max'] / df_summary[col + '_min']
+            df_summary[col + '_std_norm'] = df_summary[col + '_std'] / df_summary[col + '_mean']
+            df_summary[col + '_current_vs_mean'] = df_summary[col + '_last'] / df_summary[col + '_mean']
+            df_summary[col + '_current_vs_' + str(observation_window) + '_months_ago'] = df_summary[col + '_last'] / df_summary[col + '_first']
+        return df_summary
     
     def data_cleaning(self, df, cat_threshold, train_or_score):
-        # remove categorical columns that have more than threshold number of levels - maybe group up instead?
-        # remove categorical columns that have only 1 value
-        str_cols = df.select_dtypes(include='object')
-        drop_cols = str_cols.columns[str_cols.nunique() > cat_threshold]
-        drop_cols = drop_cols.append(str_cols.columns[str_cols.nunique() == 1])
-        drop_cols = drop_cols.append(df.select_dtypes(include='datetime64[ns]').columns)
+        # keep a record of each column that is removed and why in removed_columns
+        # fit_prep_transformer saves it with the prep transformer and scoring drops the same columns before creating dummies
+        removed_columns = {}
+        str_cols = df.select_dtypes(include=['object', 'category'])
+        if train_or_score == 'score' and self.prep_transformer is not None:
+            # use the categories that were seen in training so the same dummies are created whichever customers are scored
+            dummy_categories = self.prep_transformer['dummy_categories']
+            removed_in_training = self.prep_transformer.get('removed_columns', {})
+            removed_columns.update({col : 'not used in training' for col in str_cols.columns if col not in dummy_categories})
+            removed_columns.update({col : 'date' for col in df.select_dtypes(include='datetime64[ns]').columns})
+            removed_columns.update({col : removed_in_training[col] for col in df.columns if col in removed_in_training and col != self.granularity_key})
+            df = df.drop(list(removed_columns), axis=1)
+            for col in dummy_categories:
+                if col in df.columns:
+                    df[col] = pd.Categorical(df[col], categories=dummy_categories[col])
+        else:
+            # remove categorical columns that have more than threshold number of levels - maybe group up instead?
+            # remove categorical columns that have only 1 value
+            n_levels = str_cols.nunique()
+            removed_columns.update({col : 'more than ' + str(cat_threshold) + ' categories' for col in str_cols.columns[n_levels > cat_threshold]})
+            removed_columns.update({col : 'single category' for col in str_cols.columns[n_levels == 1]})
+            removed_columns.update({col : 'date' for col in df.select_dtypes(include='datetime64[ns]').columns})
+            df = df.drop(list(removed_columns), axis=1)
+            # a categorical column from compact_dtypes can have categories that none of these customers have,
+            # remove them so that only the values in the data get dummies, as for a string column
+            for col in df.columns:
+                if isinstance(df[col].dtype, pd.CategoricalDtype):
+                    df[col] = df[col].cat.remove_unused_categories()
+            if train_or_score == 'train':
+                # keep the categories of each column so that scoring can create the same dummies
+                self.dummy_categories = {col : sorted(str_cols[col].dropna().unique().tolist()) for col in str_cols.columns if col not in removed_columns}
 
-        df = pd.get_dummies(df.drop(drop_cols, axis=1), drop_first=True)
+        df = pd.get_dummies(df, drop_first=True)
 
         # any column that starts with 'NUM_', replace null with 0 
         # - this should be fixed with the new join at start and removed
         num_col = [col for col in df if col.startswith('NUM_')]
         df[num_col] = df[num_col].fillna(0)
 
+        # the remaining columns are screened together and then dropped at once
+        screened_columns = {}
         if train_or_score == 'train':
             # any column that has greater than 10% nulls is removed
-            # remove all columns that only have a constant value
-            for col in df.columns:
-                curr_col = df[col]
-                if (curr_col.isna().sum()/curr_col.shape[0]) > 0.1:
-                    df.drop(col, axis=1, inplace=True)
-                # if min = max the column is constant and should be dropped
-                elif curr_col.min() == curr_col.max():
-                    df.drop(col, axis=1, inplace=True)
-                
+            # remove all columns that only have a constant value - if min = max the column is constant
+            # the null ratio, min and max are computed for all of the columns in one go
+            null_ratio = df.isna().mean()
+            is_constant = df.min().reindex(df.columns) == df.max().reindex(df.columns)
+            screened_columns.update({col : 'more than 10% nulls' for col in df.columns[(null_ratio > 0.1).values]})
+            screened_columns.update({col : 'constant' for col in df.columns[((null_ratio <= 0.1) & is_constant).values]})
+
         # any variable name ending in 'TIMESTAMP' is removed, as is any column that mentions 'ROW_ID'
         # use upper here incase column names are proper or lower case
-        df = df[df.columns[~df.columns.str.upper().str.endswith('TIMESTAMP')]]
-        df = df[df.columns[~((df.columns.str.upper().str.contains('ROW_ID')) | (df.columns.str.upper().str.contains('ROWID')))]]
+        upper_cols = df.columns.str.upper()
+        screened_columns.update({col : 'name ends with TIMESTAMP' for col in df.columns[upper_cols.str.endswith('TIMESTAMP')]})
+        screened_columns.update({col : 'name contains ROW_ID' for col in df.columns[upper_cols.str.contains('ROW_ID') | upper_cols.str.contains('ROWID')]})
+        df = df.drop(list(screened_columns), axis=1)
+        removed_columns.update(screened_columns)
+        self.removed_columns = removed_columns
 
         # remove the customer_id column
         df.drop(self.granularity_key, axis=1, inplace=True)    
         
         return df
     
-    def handle_inf_null_values(self, df):
-        # drop numeric columns with infinite values
-        max_vals = df.max()
-        cols_to_drop = list(max_vals[max_vals == np.inf].index)
-        df = df.drop(cols_to_drop, axis=1)
+    def handle_inf_null_values(self, df, train_or_score='train'):
+        if train_or_score == 'score':
+            # when scoring, each customer is handled on their own so a batch of customers gives the same result
+            # as scoring them one at a time. An infinite value is set to 0, which is what the column gets
+            # when it is dropped for a single customer and added back to match the training columns
+            df = df.replace(np.inf, 0)
+        else:
+            # drop numeric columns with infinite values
+            max_vals = df.max()
+            cols_to_drop = list(max_vals[max_vals == np.inf].index)
+            df = df.drop(cols_to_drop, axis=1)
         
         # drop rows that have null values
         df = df.dropna(how='any')
         
         return df
     
-    def prep_data(self, df_raw, train_or_score):
-        np.random.seed(0)
+    def prep_data(self, df_raw, train_or_score, feature_store=None, n_shards=1, cache_dir=None):
+        # preps the customers in df_raw and then cleans the result
+        # if a RollingFeatureStore is passed in when scoring, only the records in df_raw for the months after the latest month
+        # in the store are used. They are added to the store and the customers are prepped from it, see prep_feature_store
+        # if n_shards is more than 1 the customers are split into n_shards groups and prepped in parallel processes
+        # if cache_dir is set the prepped data is cached there and reused while df_raw and the parameters are unchanged,
+        # see prep_data_cached. It is not used with a feature_store
+        if feature_store is not None:
+            if train_or_score != 'score':
+                raise ValueError('A feature store can only be used for scoring')
+            df_prepped = self.prep_feature_store(df_raw, feature_store)
+        elif cache_dir is not None:
+            return self.prep_data_cached(df_raw, train_or_score, cache_dir, n_shards)
+        elif n_shards > 1:
+            df_prepped = self.prep_shards(df_raw, train_or_score, n_shards)
+        else:
+            df_prepped = self.prep_customers(df_raw, train_or_score)
+        if df_prepped is None:
+            return None
+
+        return self.clean_prepped(df_prepped, train_or_score)
+
+    def prep_fingerprint(self, df_raw, train_or_score):
+        # a hash of everything that the prepped data depends on: the AttritionPrep parameters, this script,
+        # and the values of the columns in df_raw that the prep uses
+        params = {name : getattr(self, name) for name in ['effective_date_earliest', 'effective_date_latest', 'effective_date',
+            'columns_required', 'feature_attributes', 'derive_column_list', 'granularity_key', 'target_attribute',
+            'status_attribute', 'funds_attribute', 'date_customer_joined', 'customer_end_date', 'customer_start_date',
+            'period_attribute', 'status_flag_attrition', 'AUM_reduction_threshold', 'forecast_horizon', 'observation_window',
+            'sum_list', 'cat_threshold', 'random_seed', 'prep_transformer']}
+        fingerprint = hashlib.sha256(json.dumps([train_or_score, params], sort_keys=True, default=str).encode())
+        with open(__file__, 'rb') as f:
+            fingerprint.update(f.read())
+        for col in sorted(set(self.columns_required + self.feature_attributes) & set(df_raw.columns)):
+            fingerprint.update(col.encode())
+            fingerprint.update(pd.util.hash_pandas_object(df_raw[col], index=False).values.tobytes())
+        return fingerprint.hexdigest()
+
+    def customer_fingerprints(self, df_raw):
+        # a hash for each customer of everything their scoring prep depends on as of the effective date:
+        # their records up to the effective date - the observation window, and the history before it that decides whether they
+        # have attrited and have enough months of data - their earliest join date, and the effective date itself
+        # while a customer's hash is unchanged, prep_data(df_raw, 'score') gives them the same prepped record
+        # returns a series indexed by customer ID, customers without records up to the effective date are left out
+        columns = sorted(set(self.columns_required + self.feature_attributes) & set(df_raw.columns))
+        df = df_raw[df_raw[self.customer_end_date] <= pd.Timestamp(self.effective_date)]
+        row_hashes = pd.util.hash_pandas_object(df[columns], index=False).values
+
+        # add up the hashes of each customer's records, so the order of the records does not matter
+        order = np.argsort(df[self.granularity_key].values, kind='mergesort')
+        customer_ids = df[self.granularity_key].values[order]
+        starts = np.flatnonzero(np.r_[True, customer_ids[1:] != customer_ids[:-1]]) if len(customer_ids) > 0 else np.array([], dtype=int)
+        df_customers = pd.DataFrame({'RECORDS' : np.add.reduceat(row_hashes[order], starts) if len(starts) > 0 else np.array([], dtype='uint64')},
+                                    index=pd.Index(customer_ids[starts], name=self.granularity_key))
+        df_customers['JOINED'] = df_raw.groupby(self.granularity_key)[self.date_customer_joined].min().reindex(df_customers.index)
+        df_customers['EFFECTIVE_DATE'] = self.effective_date
+        return pd.util.hash_pandas_object(df_customers, index=False)
+
+    def prep_data_cached(self, df_raw, train_or_score, cache_dir, n_shards=1, max_entries=10):
+        # returns the prepped data from cache_dir if df_raw has been prepped with the same parameters before, otherwise preps it
+        # and saves the result there as parquet, with the user inputs, dummy categories and removed columns from the prep in json
+        # the cache entry is named by prep_fingerprint, so any change to the data, the parameters or this script misses the cache
+        # only the max_entries most recently used entries are kept, see clean_prep_cache
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        fingerprint = self.prep_fingerprint(df_raw, train_or_score)
+        data_path = os.path.join(cache_dir, 'prepped_' + fingerprint + '.parquet')
+        state_path = os.path.join(cache_dir, 'prepped_' + fingerprint + '.json')
+
+        if os.path.exists(state_path) and os.path.exists(data_path):
+            print('Using the cached prepped data ' + data_path)
+            df_prepped = pq.read_table(data_path).to_pandas()
+            # mark the entry as used so that clean_prep_cache keeps it
+            os.utime(state_path)
+            with open(state_path) as f:
+                state = json.load(f)
+            for name in state:
+                setattr(self, name, state[name])
+            if train_or_score == 'train':
+                # only write the user inputs json if it has changed since the cached prep wrote it
+                user_inputs = json.dumps(self.user_inputs_dict)
+                saved_user_inputs = None
+                if os.path.exists(self.user_inputs_path):
+                    with open(self.user_inputs_path) as f:
+                        saved_user_inputs = f.read()
+                if saved_user_inputs != user_inputs:
+                    with open(self.user_inputs_path, 'w') as f:
+                        f.write(user_inputs)
+            return df_prepped
+
+        df_prepped = self.prep_data(df_raw, train_or_score, n_shards=n_shards)
+        if df_prepped is None:
+            return None
+
+        # write to temporary files and rename them so that a cache entry is never left half written
+        # the json is written last as it marks the entry as complete
+        os.makedirs(cache_dir, exist_ok=True)
+        state = {name : getattr(self, name) for name in ['user_inputs_dict', 'dummy_categories', 'removed_columns'] if hasattr(self, name)}
+        pq.write_table(pa.Table.from_pandas(df_prepped), data_path + '.tmp')
+        os.replace(data_path + '.tmp', data_path)
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(state_path + '.tmp', state_path)
+        self.clean_prep_cache(cache_dir, max_entries)
+        return df_prepped
+
+    def clean_prep_cache(self, cache_dir, max_entries=10, max_age_days=None):
+        # removes the cache entries written by prep_data_cached that are older than max_age_days since they were last used,
+        # and then the least recently used entries so that at most max_entries are left
+        # returns the number of entries removed
+        if not os.path.isdir(cache_dir):
+            return 0
+        state_paths = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.startswith('prepped_') and name.endswith('.json')]
+        last_used = {}
+        for state_path in state_paths:
+            try:
+                last_used[state_path] = os.path.getmtime(state_path)
+            except FileNotFoundError:
+                # removed by another process cleaning the same cache
+                pass
+        # most recently used first
+        state_paths = sorted(last_used, key=last_used.get, reverse=True)
+        to_remove = state_paths[max_entries:]
+        if max_age_days is not None:
+            cutoff = time.time() - max_age_days * 24 * 60 * 60
+            to_remove += [state_path for state_path in state_paths[:max_entries] if last_used[state_path] < cutoff]
+        for state_path in to_remove:
+            # remove the json first, it marks the entry as complete
+            for path in [state_path, state_path[:-len('.json')] + '.parquet']:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return len(to_remove)
+
+    def clean_prepped(self, df_prepped, train_or_score):
+        # call the function for cleaning the data - call it here, once for all the customers, so that the same
+        # categorical dummies are created for everyone and any columns that are removed are reflected in the json output
+        stage = self.start_stage('data_cleaning', df_prepped)
+        df_prepped = self.data_cleaning(df_prepped, self.cat_threshold, train_or_score)
+        self.end_stage(stage, df_prepped)
+
+        if train_or_score == 'train':
+            # keep a list of columns that were created when the training dataset was built
+            self.user_inputs_dict['cols_used_for_training'] = list(df_prepped.columns)
+
+        elif train_or_score == 'score':
+            # Ensure that the dataset created for scoring has the same columns and order as the dataset used for training
+            # the transformer has the columns used for training without the target variable and the to_drop_corr columns
+            # a column that does not exist in scoring is added as 0, a column that was not used in training is removed
+            if self.prep_transformer is not None:
+                df_prepped = df_prepped.reindex(columns=self.prep_transformer['columns'], fill_value=0)
+
+            print('Finished prepping data for scoring')
+        
+        stage = self.start_stage('handle_inf_null_values', df_prepped)
+        df_prepped = self.handle_inf_null_values(df_prepped, train_or_score)
+        self.end_stage(stage, df_prepped)
+
+        if train_or_score == 'train':
+            # save out the user inputs and the transformer for the prepped columns
+            self.fit_prep_transformer(df_prepped)
+        return df_prepped
+
+    def fit_prep_transformer(self, df_prepped, to_drop_corr=[]):
+        # save what scoring needs to turn the prepped data into the columns the model is trained on:
+        # the categories for the dummy columns, the final column order, the columns removed by data_cleaning and why,
+        # and the columns dropped after the prep (to_drop_corr)
+        # prep_data calls this with the training data, call it again if more columns are dropped before training
+        self.user_inputs_dict['prep_transformer'] = {'dummy_categories' : self.dummy_categories,
+            'columns' : [col for col in df_prepped.columns if col != self.target_attribute and col not in to_drop_corr],
+            'to_drop_corr' : list(to_drop_corr), 'removed_columns' : self.removed_columns}
+        with open(self.user_inputs_path, 'w') as f:
+            json.dump(self.user_inputs_dict, f)
+
+    def prep_shards(self, df_raw, train_or_score, n_shards):
+        # split the customers into n_shards groups using a hash of the customer ID so all of a customer's records are in the same shard
+        # then run prep_customers on each shard in its own process
+        shard = pd.util.hash_array(np.asarray(df_raw[self.granularity_key])) % np.uint64(n_shards)
+        shards = [df_shard for _, df_shard in df_raw.groupby(shard)]
+
+        shards_prepped = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_shards) as executor:
+            futures = [executor.submit(self.prep_customers, df_shard, train_or_score) for df_shard in shards]
+            for future in futures:
+                # a shard can end up with no customers to prep, only stop if that is true for all of them
+                try:
+                    df_shard_prepped = future.result()
+                except NoCustomersError:
+                    df_shard_prepped = None
+                if df_shard_prepped is not None:
+                    shards_prepped.append(df_shard_prepped)
+
+        if len(shards_prepped) == 0:
+            raise NoCustomersError('No customers left to prep in any of the shards')
+
+        return self.order_prepped(pd.concat(shards_prepped), train_or_score)
+
+    def order_prepped(self, df_prepped, train_or_score):
+        # put the customers back in the order prep_customers gives them when it preps everyone at once
+        # attrited customers first when training, each ordered by customer ID
+        if train_or_score == 'train':
+            df_prepped = df_prepped.sort_values(by=[self.target_attribute, self.granularity_key], ascending=[False, True], kind='mergesort')
+        elif train_or_score == 'score':
+            df_prepped = df_prepped.sort_index()
+        return df_prepped
+
+    def read_history_chunks(self, history, chunksize=100000):
+        # yields the columns of the customer history that are used by the prep in chunks of chunksize records
+        # history can be the path to a csv or parquet file, an open csv file, or an iterable of dataframes
+        default_attributes = list(set(self.columns_required + self.feature_attributes))
+        if isinstance(history, str) and history.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            parquet_file = pq.ParquetFile(history)
+            columns = [col for col in default_attributes if col in parquet_file.schema_arrow.names]
+            return (batch.to_pandas() for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns))
+        elif isinstance(history, str) or hasattr(history, 'read'):
+            return pd.read_csv(history, usecols=lambda col: col in default_attributes, chunksize=chunksize,
+                               parse_dates=[self.date_customer_joined, self.customer_end_date, self.customer_start_date],
+                               infer_datetime_format=True)
+        return history
+
+    def sort_history(self, history, output_path, n_buckets=16, chunksize=100000):
+        # writes the customer history to a csv at output_path with all of the records for each customer next to each other,
+        # which is the order that prep_stream needs, e.g. from the parquet file written by history_to_parquet which is ordered by month
+        # history is anything that read_history_chunks accepts. The whole history is never in memory at once:
+        # the records are first split into n_buckets files by a hash of the customer ID, then each bucket is sorted by customer ID
+        # and date and appended to the output
+        import tempfile
+        with tempfile.TemporaryDirectory() as bucket_dir:
+            bucket_paths = [os.path.join(bucket_dir, 'bucket_' + str(i) + '.csv') for i in range(n_buckets)]
+            columns = None
+            for df_chunk in self.read_history_chunks(history, chunksize):
+                if columns is None:
+                    columns = list(df_chunk.columns)
+                bucket = pd.util.hash_array(np.asarray(df_chunk[self.granularity_key])) % np.uint64(n_buckets)
+                for i, df_bucket in df_chunk[columns].groupby(bucket):
+                    df_bucket.to_csv(bucket_paths[i], mode='a', header=not os.path.exists(bucket_paths[i]), index=False)
+
+            if columns is None:
+                raise ValueError('The customer history has no records')
+            header = True
+            for bucket_path in bucket_paths:
+                if not os.path.exists(bucket_path):
+                    continue
+                df_bucket = pd.read_csv(bucket_path, parse_dates=[col for col in [self.date_customer_joined, self.customer_end_date,
+                                        self.customer_start_date] if col in columns], float_precision='round_trip')
+                df_bucket = df_bucket.sort_values(by=[self.granularity_key, self.customer_end_date], kind='mergesort')
+                df_bucket.to_csv(output_path, mode='w' if header else 'a', header=header, index=False)
+                header = False
+
+    def iter_customer_chunks(self, history, chunksize=100000):
+        # yields the customer history in chunks of about chunksize records without splitting a customer's records across chunks
+        # history is anything that read_history_chunks accepts,
+        # e.g. pd.read_sql('select * from CUSTOMER_HISTORY_VIEW order by CUSTOMER_CUSTOMER_ID', conn, chunksize=chunksize)
+        # either way all of the records for a customer must be next to each other, e.g. sorted by customer ID, see sort_history
+        chunks = self.read_history_chunks(history, chunksize)
+
+        cust_seen = set()
+        df_carry = None
+        for df_chunk in chunks:
+            if df_carry is not None:
+                df_chunk = pd.concat([df_carry, df_chunk], ignore_index=True)
+            if df_chunk.shape[0] == 0:
+                continue
+            # hold back the last customer in the chunk, their records may carry on in the next chunk
+            is_last_cust = (df_chunk[self.granularity_key] == df_chunk[self.granularity_key].iloc[-1]).values
+            df_carry = df_chunk[is_last_cust]
+            df_chunk = df_chunk[~is_last_cust]
+            if df_chunk.shape[0] > 0:
+                cust_in_chunk = set(df_chunk[self.granularity_key].unique())
+                if not cust_seen.isdisjoint(cust_in_chunk):
+                    raise ValueError('The customer history must be ordered so that the records for each ' + self.granularity_key + ' are together')
+                cust_seen.update(cust_in_chunk)
+                yield df_chunk
+
+        if df_carry is not None and df_carry.shape[0] > 0:
+            if df_carry[self.granularity_key].iloc[0] in cust_seen:
+                raise ValueError('The customer history must be ordered so that the records for each ' + self.granularity_key + ' are together')
+            yield df_carry
+
+    def prep_stream(self, history, train_or_score, output_path, chunksize=100000):
+        # preps the customer history one chunk of customers at a time so that the whole history is never in memory at once
+        # history is anything that iter_customer_chunks accepts
+        # the prepped records (one per customer) are appended to the csv at output_path as each chunk is finished,
+        # then read back and cleaned together so that the categorical dummies are the same for every customer
+        prepped_columns = None
+        for df_chunk in self.iter_customer_chunks(history, chunksize):
+            # a chunk can have no customers to prep, only stop if that is true for all of them
+            try:
+                df_chunk_prepped = self.prep_customers(df_chunk, train_or_score)
+            except NoCustomersError:
+                df_chunk_prepped = None
+            if df_chunk_prepped is None:
+                continue
+
+            if prepped_columns is None:
+                prepped_columns = list(df_chunk_prepped.columns)
+                df_chunk_prepped.to_csv(output_path, index=False)
+            else:
+                df_chunk_prepped[prepped_columns].to_csv(output_path, mode='a', header=False, index=False)
+
+        if prepped_columns is None:
+            raise NoCustomersError('No customers left to prep in any of the chunks')
+
+        df_prepped = pd.read_csv(output_path, float_precision='round_trip')
+        if train_or_score == 'score':
+            # index the rows by customer ID as prep_customers does
+            df_prepped = df_prepped.set_index(self.granularity_key, drop=False)
+        return self.clean_prepped(self.order_prepped(df_prepped, train_or_score), train_or_score)
+
+    def prep_backtest(self, df_raw, effective_dates):
+        # preps the customers for scoring as of each of the effective_dates, e.g. every month end of the last 2 years
+        # to backtest the model or look for drift, in one pass over the history instead of one prep_data for each date
+        # returns the same rows as prep_data(df_raw, 'score') with effective_date set to each date in turn,
+        # indexed by customer ID and effective date
+        efd_list = sorted(set(pd.Timestamp(efd).to_pydatetime() for efd in effective_dates))
+        efd_labels = np.array([datetime.datetime.strftime(efd, '%Y-%m-%d') for efd in efd_list])
+
+        stage = self.start_stage('filter_attributes', df_raw)
+        df_raw = self.filter_attributes(df_raw)
+        self.end_stage(stage, df_raw)
+
+        # join dates are filled from the whole history, as prep_data does
+        stage = self.start_stage('fill_date_customer_joined', df_raw)
+        df_raw = self.fill_date_customer_joined(df_raw)
+        self.end_stage(stage, df_raw)
+
+        # records after the latest effective date are not used for any of them
+        stage = self.start_stage('effective_date_filter', df_raw)
+        df_raw = df_raw.sort_values(by=[self.granularity_key, self.customer_end_date])
+        df_raw = df_raw[df_raw[self.customer_end_date]<=efd_list[-1]]
+        self.end_stage(stage, df_raw)
+
+        print('Dataframe shape: ' + str(df_raw.shape))
+        if df_raw[self.granularity_key].nunique() == 0:
+            print('No customers to score. Check effective date', file=sys.stderr)
+            return None
+
+        # the attrition flag for a month only depends on the months before it, so it is the same for every effective date
+        # a customer has attrited as of a record if they attrited in that month or any month before it
+        stage = self.start_stage('define_attrition', df_raw)
+        df_raw['AUM_reduction_threshold'] = self.AUM_reduction_threshold
+        df_raw = self.define_attrition_monthly(df_raw)
+        df_raw[self.target_attribute] = df_raw.groupby(self.granularity_key)['attrition'].cummax()
+        self.end_stage(stage, df_raw)
+
+        # as when scoring, the observation window for an effective date starts observation_window months before the day after it
+        # the windows are in order of both their start and end dates, so each record is in a run of consecutive windows:
+        # from the first that ends on or after the record to the last that starts on or before it
+        # repeat each record once for each window it is in, SNAPSHOT is the position of the window in efd_list
+        stage = self.start_stage('backtest_windows', df_raw)
+        efd_ends = np.array(efd_list, dtype='datetime64[ns]')
+        efd_starts = np.array([efd + datetime.timedelta(days=1) - relativedelta(months=self.observation_window) for efd in efd_list], dtype='datetime64[ns]')
+        end_dates = df_raw[self.customer_end_date].values
+        first_window = np.searchsorted(efd_ends, end_dates, side='left')
+        n_windows = np.maximum(np.searchsorted(efd_starts, end_dates, side='right') - first_window, 0)
+        window_offset = np.arange(n_windows.sum()) - np.repeat(np.cumsum(n_windows) - n_windows, n_windows)
+        df_windows = df_raw.iloc[np.repeat(np.arange(df_raw.shape[0]), n_windows)].reset_index(drop=True)
+        df_windows['SNAPSHOT'] = np.repeat(first_window, n_windows) + window_offset
+
+        # for each customer and effective date, check that the customer has not attrited by the effective date
+        # and that they have at least observation_window months of data up to it
+        # the last record in the window is their last record up to the effective date
+        df_snapshots = df_windows.groupby([self.granularity_key, 'SNAPSHOT']).agg(MAX_DATE=(self.customer_end_date, 'max'),
+                                                                              ATTRITED=(self.target_attribute, 'max')).reset_index()
+        df_snapshots['MIN_DATE'] = df_snapshots[self.granularity_key].map(df_raw.groupby(self.granularity_key)[self.customer_end_date].min())
+        df_snapshots['PERIODS_OF_DATA'] = self.vec_n_months(df_snapshots['MAX_DATE'], df_snapshots['MIN_DATE'])
+        df_snapshots = df_snapshots[(df_snapshots['ATTRITED'] == 0) & (df_snapshots['PERIODS_OF_DATA']>=self.observation_window)]
+
+        print('We have ' + str(df_snapshots.shape[0]) + ' customers and effective dates to score')
+        if df_snapshots.shape[0] == 0:
+            raise NoCustomersError('No customer left for scoring. No customers had enough months of data')
+
+        missing_data_snapshots = df_snapshots['MAX_DATE'].values.astype('datetime64[M]') < efd_ends[df_snapshots['SNAPSHOT'].values].astype('datetime64[M]')
+        if missing_data_snapshots.any():
+            print('There are ' + str(missing_data_snapshots.sum()) + ' customers and effective dates without data up to the effective date.')
+
+        df_windows = df_windows.merge(df_snapshots[[self.granularity_key, 'SNAPSHOT']], on=[self.granularity_key, 'SNAPSHOT'], how='inner')
+        df_windows['OBS_MONTH_MIN_OW'] = efd_starts[df_windows['SNAPSHOT'].values]
+        self.end_stage(stage, df_windows)
+
+        col_list = [attribute for attribute in self.derive_column_list if attribute in df_windows.columns]
+        stage = self.start_stage('derive_features', df_windows)
+        df_prepped = self.derive_features(df_windows, col_list, self.observation_window, snapshot_key='SNAPSHOT')
+        self.end_stage(stage, df_prepped)
+
+        df_prepped.drop('OBS_MONTH_MIN_OW', axis=1, inplace=True)
+        # index the rows by customer ID and effective date so that scores can be matched back to them
+        df_prepped.index = pd.MultiIndex.from_arrays([df_prepped[self.granularity_key].values, efd_labels[df_prepped['SNAPSHOT'].values]],
+                                                     names=[self.granularity_key, 'effective_date'])
+        df_prepped.drop('SNAPSHOT', axis=1, inplace=True)
+        # add new column for customer tenure
+        df_prepped[self.period_attribute] = self.vec_n_months(df_prepped[self.customer_end_date], df_prepped[self.date_customer_joined])
+        # drop any column that looks like a date
+        for col in df_prepped.columns:
+            if df_prepped[col].dtype == 'datetime64[ns]':
+                df_prepped.drop(col, axis=1, inplace=True)
+
+        return self.clean_prepped(df_prepped, 'score')
+
+    def prep_customers(self, df_raw, train_or_score):
         # call the function to filter to only the selected attributes
+        stage = self.start_stage('filter_attributes', df_raw)
         df_raw = self.filter_attributes(df_raw)
+        self.end_stage(stage, df_raw)
         
         # fill missing customer join dates with the earliest customer start date
+        stage = self.start_stage('fill_date_customer_joined', df_raw)
         df_raw = self.fill_date_customer_joined(df_raw)
+        self.end_stage(stage, df_raw)
 
         # order the dataframe by customer ID and customer_end_date
         # makes it easier later on for selecting first and last records for a customer
+        stage = self.start_stage('effective_date_filter', df_raw)
         df_raw = df_raw.sort_values(by=[self.granularity_key, self.customer_end_date])
 
         # filter to include only records within the effective date range
@@ -303,6 +930,7 @@ class AttritionPrep():
 
         # remove records that are after our new latest date and before the new earliest date
         df_raw = df_raw[(df_raw[self.customer_end_date]>=efd_earliest) & (df_raw[self.customer_end_date]<=efd_latest)]
+        self.end_stage(stage, df_raw)
 
         print('Dataframe shape: ' + str(df_raw.shape))
         print('Count of customers: ' + str(df_raw[self.granularity_key].nunique())) 
@@ -312,12 +940,14 @@ class AttritionPrep():
           return None
 
         # add AUM_reduction_threshold column with the user defined threshold
+        stage = self.start_stage('define_attrition', df_raw)
         df_raw['AUM_reduction_threshold'] = self.AUM_reduction_threshold
 
         # call function to define attrition flag for each month
         df_raw = self.define_attrition_monthly(df_raw)
         # call the function that determines if the customer has attrited at any point in their tenure
         df_raw = self.define_attrition_overall(df_raw)
+        self.end_stage(stage, df_raw)
 
         attrited_df = df_raw[df_raw[self.target_attribute] == 1].copy()
 
@@ -329,16 +959,17 @@ class AttritionPrep():
             # ensures that attrition happened within horecast_horizon of cutoff date
 
             # filter to include only months where attrition=1, get the first occurance per customer
+            stage = self.start_stage('attrited_cutoff_sampling', attrited_df)
             df_attrited_first_occ = attrited_df[attrited_df['attrition']==1].groupby(self.granularity_key)[self.customer_end_date].min().reset_index()
             # note that we pick the 1st of the month as the attrition happening
             # create a random number to be used to select cutoff date before the attrition happened and within forecast_horizon
-            df_attrited_first_occ['RAND'] = np.random.rand(df_attrited_first_occ.shape[0])
-            df_attrited_first_occ['CUTOFF_DATE'] = df_attrited_first_occ.apply(lambda x: self.udf_sub_rand_latency(x[self.customer_end_date], x['RAND'], self.forecast_horizon), axis=1)
+            df_attrited_first_occ['RAND'] = self.customer_rand(df_attrited_first_occ[self.granularity_key])
+            df_attrited_first_occ['CUTOFF_DATE'] = self.vec_sub_rand_latency(df_attrited_first_occ[self.customer_end_date], df_attrited_first_occ['RAND'], self.forecast_horizon)
             # drop columns that we don't need anymore
             df_attrited_first_occ.drop([self.customer_end_date, 'RAND'], axis=1, inplace=True)
             # the start of the observation window is observation_months before the cutoff_date
             # get the start month of the observation window
-            df_attrited_first_occ['OBS_MONTH_MIN_OW'] = df_attrited_first_occ.apply(lambda x: x['CUTOFF_DATE'] - relativedelta(months=self.observation_window), axis=1)
+            df_attrited_first_occ['OBS_MONTH_MIN_OW'] = self.vec_add_months(df_attrited_first_occ['CUTOFF_DATE'], -self.observation_window)
 
             # filter to only include records per customer from before their cutoff month
             # if a customer has no records before the cutoff date, they are removed from the dataset
@@ -351,12 +982,13 @@ class AttritionPrep():
             # they must have at least observation_window number of months between first and last date of CUSTOMER_SUMMARY_END_DATE (customer_end_date)
             attrited_cust_with_enough_history = attrited_df_b4_cutoff.groupby(self.granularity_key)[self.customer_end_date].agg([max, min]).reset_index()
             attrited_cust_with_enough_history.columns = [self.granularity_key, 'MAX_DATE', 'MIN_DATE']
-            attrited_cust_with_enough_history['PERIODS_OF_DATA'] = attrited_cust_with_enough_history.apply(lambda x: self.udf_n_months(x['MAX_DATE'], x['MIN_DATE']), axis=1)
+            attrited_cust_with_enough_history['PERIODS_OF_DATA'] = self.vec_n_months(attrited_cust_with_enough_history['MAX_DATE'], attrited_cust_with_enough_history['MIN_DATE'])
             # remove anyone without enough observation window months
             attrited_cust_with_enough_history = attrited_cust_with_enough_history[attrited_cust_with_enough_history['PERIODS_OF_DATA']>=self.observation_window]
             # inner join back to attrited data to just leave customers who have enough data in observation window
             attrited_df_b4_cutoff_filtered = attrited_df_b4_cutoff.merge(attrited_cust_with_enough_history, on=self.granularity_key, how='inner')
             attrited_df_b4_cutoff_filtered.drop(['MAX_DATE', 'MIN_DATE', 'PERIODS_OF_DATA'], axis=1, inplace=True)
+            self.end_stage(stage, attrited_df_b4_cutoff_filtered)
             # next we derive features based on list passed
             # the user can pass a specific list or use the default 
 
@@ -364,17 +996,17 @@ class AttritionPrep():
             col_list = [attribute for attribute in self.derive_column_list if attribute in attrited_df_b4_cutoff_filtered.columns]
             print('Columns available for deriving features: ' +str(col_list))
             # call the function to derive summary stats for each of the features passed in the list
-            attrited_df_features = self.derive_features(attrited_df_b4_cutoff_filtered, col_list, self.observation_window)
-
-            # keep only the latest month prior to the cutoff for each customer
-            # use last here in the event that there is more than 1 record for last date
-            attrited_df_prepped = attrited_df_features.groupby(self.granularity_key).last().reset_index()
+            # this returns the latest month prior to the cutoff for each customer
+            stage = self.start_stage('attrited_derive_features', attrited_df_b4_cutoff_filtered)
+            attrited_df_prepped = self.derive_features(attrited_df_b4_cutoff_filtered, col_list, self.observation_window)
+            self.end_stage(stage, attrited_df_prepped)
 
             print('Prepped data for ' + str(attrited_df_prepped.shape[0]) + ' customers')
             print('Finished prepping for attrited customers')
 
             # start prep for non attrited customers
             # very similar to above but we select a random cutoff date 
+            stage = self.start_stage('non_attrited_cutoff_sampling', df_raw)
             non_attrited_df = df_raw[df_raw[self.target_attribute] == 0].copy()
 
             n_months = self.forecast_horizon + self.observation_window
@@ -384,37 +1016,36 @@ class AttritionPrep():
 
             non_attrited_cust_with_enough_history = non_attrited_df.groupby(self.granularity_key)[self.customer_end_date].agg([max, min]).reset_index()
             non_attrited_cust_with_enough_history.columns = [self.granularity_key, 'MAX_DATE', 'MIN_DATE']
-            non_attrited_cust_with_enough_history['PERIODS_OF_DATA'] = non_attrited_cust_with_enough_history.apply(lambda x: self.udf_n_months(x['MAX_DATE'], x['MIN_DATE']), axis=1)
+            non_attrited_cust_with_enough_history['PERIODS_OF_DATA'] = self.vec_n_months(non_attrited_cust_with_enough_history['MAX_DATE'], non_attrited_cust_with_enough_history['MIN_DATE'])
             # remove anyone that doesn't have observation_window + forecast_horizon months of data
             non_attrited_cust_with_enough_history = non_attrited_cust_with_enough_history[non_attrited_cust_with_enough_history['PERIODS_OF_DATA']>=n_months]
-            non_attrited_cust_with_enough_history['RAND'] = np.random.rand(non_attrited_cust_with_enough_history.shape[0])
+            non_attrited_cust_with_enough_history['RAND'] = self.customer_rand(non_attrited_cust_with_enough_history[self.granularity_key])
             # select a random cutoff that will still give enough history and enough forecast_horizon
             # ensure that the max date that can be selected still gives enough forecast_horizon (temp_date)
-            non_attrited_cust_with_enough_history['TEMP_DATE'] = non_attrited_cust_with_enough_history.apply(lambda x: x['MAX_DATE'] + relativedelta(months=1-self.forecast_horizon), axis=1)
-            non_attrited_cust_with_enough_history['CUTOFF_DATE'] = non_attrited_cust_with_enough_history.apply(lambda x: self.udf_sub_rand_latency(x['TEMP_DATE'], x['RAND'], x['PERIODS_OF_DATA'] - n_months), axis=1)
+            non_attrited_cust_with_enough_history['TEMP_DATE'] = self.vec_add_months(non_attrited_cust_with_enough_history['MAX_DATE'], 1-self.forecast_horizon)
+            non_attrited_cust_with_enough_history['CUTOFF_DATE'] = self.vec_sub_rand_latency(non_attrited_cust_with_enough_history['TEMP_DATE'], non_attrited_cust_with_enough_history['RAND'], non_attrited_cust_with_enough_history['PERIODS_OF_DATA'] - n_months)
             non_attrited_cust_with_enough_history.drop('TEMP_DATE', axis=1, inplace=True)
             # join back to non_attrited_df and filter to save only records before the cutoff date
             non_attrited_df_b4_cutoff_filtered = non_attrited_df.merge(non_attrited_cust_with_enough_history, on=self.granularity_key, how='inner')
             non_attrited_df_b4_cutoff_filtered = non_attrited_df_b4_cutoff_filtered[non_attrited_df_b4_cutoff_filtered[self.customer_end_date]<non_attrited_df_b4_cutoff_filtered['CUTOFF_DATE']].copy()
             # get the start month of the observation window
-            non_attrited_df_b4_cutoff_filtered['OBS_MONTH_MIN_OW'] = non_attrited_df_b4_cutoff_filtered.apply(lambda x: x['CUTOFF_DATE'] - relativedelta(months=self.observation_window), axis=1)
+            non_attrited_df_b4_cutoff_filtered['OBS_MONTH_MIN_OW'] = self.vec_add_months(non_attrited_df_b4_cutoff_filtered['CUTOFF_DATE'], -self.observation_window)
             # drop the columns that we don't need
             non_attrited_df_b4_cutoff_filtered.drop(['MAX_DATE', 'MIN_DATE', 'PERIODS_OF_DATA', 'RAND'], axis=1, inplace=True)
+            self.end_stage(stage, non_attrited_df_b4_cutoff_filtered)
 
             # derive additional features based on list passed in config
-            non_attrited_df_features = self.derive_features(non_attrited_df_b4_cutoff_filtered, col_list, self.observation_window)
-
-            # take the most recent date for each customer
-            # keep only the latest month prior to the cutoff for each customer
-            # use last here in the event that there is more than 1 record for last date
-            non_attrited_df_prepped = non_attrited_df_features.groupby(self.granularity_key).last().reset_index()
+            # this returns the latest month prior to the cutoff for each customer
+            stage = self.start_stage('non_attrited_derive_features', non_attrited_df_b4_cutoff_filtered)
+            non_attrited_df_prepped = self.derive_features(non_attrited_df_b4_cutoff_filtered, col_list, self.observation_window)
+            self.end_stage(stage, non_attrited_df_prepped)
 
             print('Prepped data for ' + str(non_attrited_df_prepped.shape[0]) + ' customers')
             print('Finished prepping for non-attrited customers')
 
             df_prepped = pd.concat([attrited_df_prepped, non_attrited_df_prepped])
             # add new column for customer tenure
-            df_prepped[self.period_attribute] = df_prepped.apply(lambda x: self.udf_n_months(x[self.customer_end_date], x[self.date_customer_joined]), axis=1)
+            df_prepped[self.period_attribute] = self.vec_n_months(df_prepped[self.customer_end_date], df_prepped[self.date_customer_joined])
             # drop columns that aren't needed 
             df_prepped.drop(['RATIO', 'FUNDS_DROP', 'attrition', 'OBS_MONTH_MIN_OW', 'AUM_PREV_MONTH'], axis=1, inplace=True)
             # drop any column that looks like a date
@@ -422,19 +1053,9 @@ class AttritionPrep():
                 if df_prepped[col].dtype == 'datetime64[ns]':
                     df_prepped.drop(col, axis=1, inplace=True)
 
-            # call the function for cleaning the data - call it here so that any columns that are removed
-            # are reflected in the json output
-            df_prepped = self.data_cleaning(df_prepped, self.cat_threshold, train_or_score)
-
-            # save out the user inputs 
-            # and a list of columns that were created when the training dataset was built
-            self.user_inputs_dict['cols_used_for_training'] = list(df_prepped.columns)
-            with open('/project_data/data_asset/training_user_inputs_and_prepped_column_names.json', 'w') as f:
-                json.dump(self.user_inputs_dict, f)
-            
-            
         elif train_or_score == 'score':
 
+            stage = self.start_stage('score_window', df_raw)
             non_attrited_df = df_raw[df_raw[self.target_attribute] == 0].copy()
 
             # filter out customers with too little data
@@ -442,14 +1063,13 @@ class AttritionPrep():
 
             non_attrited_cust_with_enough_history = non_attrited_df.groupby(self.granularity_key)[self.customer_end_date].agg([max, min]).reset_index()
             non_attrited_cust_with_enough_history.columns = [self.granularity_key, 'MAX_DATE', 'MIN_DATE']
-            non_attrited_cust_with_enough_history['PERIODS_OF_DATA'] = non_attrited_cust_with_enough_history.apply(lambda x: self.udf_n_months(x['MAX_DATE'], x['MIN_DATE']), axis=1)
+            non_attrited_cust_with_enough_history['PERIODS_OF_DATA'] = self.vec_n_months(non_attrited_cust_with_enough_history['MAX_DATE'], non_attrited_cust_with_enough_history['MIN_DATE'])
             # filter to keep only those who have at least observation_window months of data
             non_attrited_cust_with_enough_history = non_attrited_cust_with_enough_history[non_attrited_cust_with_enough_history['PERIODS_OF_DATA']>=self.observation_window]
 
             print('We have ' + str(non_attrited_cust_with_enough_history.shape[0]) + ' customers to score')
             if non_attrited_cust_with_enough_history.shape[0] == 0:
-                print('Error : No customer left for scoring. No customers had enough months of data', file=sys.stderr)
-                sys.exit(1)
+                raise NoCustomersError('No customer left for scoring. No customers had enough months of data')
 
             # identify customers who do not have data for their last month
             # - the same month as the effective date
@@ -471,55 +1091,352 @@ class AttritionPrep():
             non_attrited_df_b4_cutoff_filtered = non_attrited_df.merge(non_attrited_cust_with_enough_history, on=self.granularity_key, how='inner')
             non_attrited_df_b4_cutoff_filtered = non_attrited_df_b4_cutoff_filtered[non_attrited_df_b4_cutoff_filtered[self.customer_end_date]>=non_attrited_df_b4_cutoff_filtered['OBS_MONTH_MIN_OW']].copy()
             if non_attrited_df_b4_cutoff_filtered.shape[0] == 0:
-                print('Error : No customer left for scoring. No customers had data within the observation window')
-                sys.exit(1)
+                raise NoCustomersError('No customer left for scoring. No customers had data within the observation window')
 
             # drop the columns that we don't need
             non_attrited_df_b4_cutoff_filtered.drop(['MAX_DATE', 'MIN_DATE', 'PERIODS_OF_DATA'], axis=1, inplace=True)
+            self.end_stage(stage, non_attrited_df_b4_cutoff_filtered)
 
             col_list = [attribute for attribute in self.derive_column_list if attribute in non_attrited_df_b4_cutoff_filtered.columns]
-            # call the function to derive summary features
-            non_attrited_df_features = self.derive_features(non_attrited_df_b4_cutoff_filtered, col_list, self.observation_window)
-
-            non_attrited_df_features.drop('OBS_MONTH_MIN_OW', axis=1, inplace=True)
-            # take the most recent date for each customer
-            # keep only the latest month for each customer (the effective date month)
-            # use last here in the event that there is more than 1 record for last date
-            df_prepped = non_attrited_df_features.groupby(self.granularity_key).last().reset_index()
-            # add new column for customer tenure
-            df_prepped[self.period_attribute] = df_prepped.apply(lambda x: self.udf_n_months(x[self.customer_end_date], x[self.date_customer_joined]), axis=1)
-            # drop any column that looks like a date
-            for col in df_prepped.columns:
-                if df_prepped[col].dtype == 'datetime64[ns]':
-                    df_prepped.drop(col, axis=1, inplace=True)
-
-            # call the function to clean the data
-            df_prepped = self.data_cleaning(df_prepped, self.cat_threshold, train_or_score)
+            df_prepped = self.score_features(non_attrited_df_b4_cutoff_filtered, col_list)
 
-            # Ensure that the dataset created for scoring has the same columns and order as the dataset used for training
-            # Read in the list of columns that were used for the training dataset
-            ##with open('/project_data/data_asset/training_user_inputs_and_prepped_column_names.json', 'r') as f:
-                ##user_inputs_df_cols_dict = json.load(f)
-            
-            ##cols_used_for_training = user_inputs_df_cols_dict['cols_used_for_training']
-
-            # don't need to include target variable for scoring
-            #cols_used_for_training.remove(self.target_attribute)
-
-            # if a column does not exist in scoring but is in training, add the column to scoring dataset
-            ##for col in cols_used_for_training:
-                ##if col not in list(df_prepped.columns):
-                    ##df_prepped[col] = 0
-
-            # if a column exists in scoring but not in training, delete it from scoring dataset
-            ##for col in list(df_prepped.columns):
-                ##if col not in cols_used_for_training:
-                    ##df_prepped.drop(col, axis=1, inplace=True)
-
-            # make sure order of scoring columns is same as training dataset
-            ##df_prepped = df_prepped[cols_used_for_training]
+        return df_prepped
 
-            print('Finished prepping data for scoring')
-        
-        df_prepped = self.handle_inf_null_values(df_prepped)
+    def score_features(self, df_window, col_list, df_summary=None):
+        # call the function to derive summary features for the customers being scored
+        # df_summary can be passed in when the summary statistics are already available, e.g. from a RollingFeatureStore
+        stage = self.start_stage('derive_features', df_window)
+        # this returns the latest month for each customer (the effective date month)
+        df_prepped = self.derive_features(df_window, col_list, self.observation_window, df_summary)
+        self.end_stage(stage, df_prepped)
+
+        df_prepped.drop('OBS_MONTH_MIN_OW', axis=1, inplace=True)
+        # index the rows by customer ID so that scores can be matched back to the customer
+        # after the customer ID column is dropped in data_cleaning
+        df_prepped = df_prepped.set_index(self.granularity_key, drop=False)
+        # add new column for customer tenure
+        df_prepped[self.period_attribute] = self.vec_n_months(df_prepped[self.customer_end_date], df_prepped[self.date_customer_joined])
+        # drop any column that looks like a date
+        for col in df_prepped.columns:
+            if df_prepped[col].dtype == 'datetime64[ns]':
+                df_prepped.drop(col, axis=1, inplace=True)
         return df_prepped
+
+    def prep_feature_store(self, df_raw, feature_store):
+        # preps the customers for scoring from a RollingFeatureStore, the same rows as prep_customers gives from the whole history
+        # the records in df_raw for the months after the latest month in the store, up to the effective date, are added to the store first,
+        # so df_raw only needs to have the months that have not been added to the store yet, e.g. the new month of data
+        efd_latest = datetime.datetime.strptime(self.effective_date, '%Y-%m-%d')
+        stage = self.start_stage('feature_store_update', df_raw)
+        df_new = feature_store.new_rows(df_raw)
+        feature_store.update(df_new[df_new[self.customer_end_date]<=efd_latest])
+        self.end_stage(stage, feature_store.records)
+
+        if feature_store.records is None:
+            raise ValueError('The feature store is empty')
+        # the summary statistics of the observation window, this checks that the store has the months up to the effective date
+        col_list = [attribute for attribute in self.derive_column_list if attribute in feature_store.records.columns]
+        df_summary = feature_store.summary(efd_latest, col_list)
+
+        # keep the customers who have not attrited and have at least observation_window months of data up to their latest record
+        # in the observation window. The window is counted back from the effective date as in prep_customers
+        stage = self.start_stage('score_window', feature_store.records)
+        obs_month_min_ow = efd_latest + datetime.timedelta(days=1) - relativedelta(months=self.observation_window)
+        df_window = feature_store.records[feature_store.records[self.customer_end_date]>=obs_month_min_ow]
+        df_history = feature_store.customer_history()
+        cust_with_enough_history = df_window.groupby(self.granularity_key)[self.customer_end_date].max().rename('MAX_DATE').reset_index()
+        cust_with_enough_history['MIN_DATE'] = cust_with_enough_history[self.granularity_key].map(df_history['MIN_DATE'])
+        cust_with_enough_history['PERIODS_OF_DATA'] = self.vec_n_months(cust_with_enough_history['MAX_DATE'], cust_with_enough_history['MIN_DATE'])
+        cust_with_enough_history = cust_with_enough_history[(cust_with_enough_history[self.granularity_key].map(df_history[self.target_attribute]) == 0) &
+                                                            (cust_with_enough_history['PERIODS_OF_DATA']>=self.observation_window)]
+
+        print('We have ' + str(cust_with_enough_history.shape[0]) + ' customers to score')
+        if cust_with_enough_history.shape[0] == 0:
+            raise NoCustomersError('No customer left for scoring. No customers had enough months of data')
+
+        missing_data_cust = cust_with_enough_history[cust_with_enough_history['MAX_DATE'].dt.strftime('%Y%m').astype(int)<int(efd_latest.strftime('%Y%m'))]
+        if missing_data_cust.shape[0] > 0:
+            print('There are ' + str(missing_data_cust.shape[0]) + ' customers who do not have data up to the effective date.')
+
+        df_window = df_window[df_window[self.granularity_key].isin(cust_with_enough_history[self.granularity_key])].copy()
+        # the join dates are filled from the customer's whole history, as fill_date_customer_joined does
+        df_window[self.date_customer_joined] = df_window[self.date_customer_joined].fillna(df_window[self.granularity_key].map(df_history[self.date_customer_joined]))
+        df_window[self.target_attribute] = 0
+        df_window['OBS_MONTH_MIN_OW'] = obs_month_min_ow
+        self.end_stage(stage, df_window)
+
+        return self.score_features(df_window, col_list, df_summary)
+
+
+def log_stage(stage):
+    # a stage_observer that writes each stage of the prep as a json log message
+    # e.g. AttritionPrep('train', stage_observer=log_stage) after logging.basicConfig(level=logging.INFO)
+    logging.getLogger('attrition_prep').info(json.dumps(stage))
+
+
+class RollingFeatureStore():
+    # keeps what AttritionPrep needs to prep the customers for scoring without going back over the whole customer history:
+    # the records of the last observation_window months, their derive_column_list values for the summary statistics,
+    # and for each customer the date of their first record, their join date, their last funds under management and whether they have attrited
+    # values are held in a ring buffer with one slot per month in the observation window (slot = month index % observation_window)
+    # when a new month arrives it overwrites the slot of the month that has dropped out of the window
+    # usage:
+    #   store = RollingFeatureStore(prep)
+    #   store.update(df_history)          # once, with the history we already have
+    #   store.save('feature_store.npz')
+    #   df_prepped = prep.prep_data(df_new_month, 'score', feature_store=store)    # every month after that, adds the month to the store
+    def __init__(self, prep, col_list=None):
+        self.prep = prep
+        self.observation_window = prep.observation_window
+        self.col_list = col_list
+        self.customer_ids = None
+        self.months = None
+        self.values = None
+        self.min_dates = None
+        self.joined_dates = None
+        self.start_dates = None
+        self.last_funds = None
+        self.attrited = None
+        self.records = None
+
+    def last_month(self):
+        # the latest month in the store as a month index (months since 1970-01), None if the store is empty
+        if self.months is None or (self.months < 0).all():
+            return None
+        return int(self.months.max())
+
+    def new_rows(self, df):
+        # the rows of df for the months after the latest month in the store
+        last_month = self.last_month()
+        if last_month is None:
+            return df
+        return df[df[self.prep.customer_end_date].values.astype('datetime64[M]').astype('int64') > last_month]
+
+    def add_customers(self, customer_ids):
+        # add rows for customers that we haven't seen before
+        n = len(customer_ids)
+        if self.customer_ids is None:
+            self.customer_ids = np.array([], dtype=np.asarray(customer_ids).dtype)
+            self.months = np.empty((0, self.observation_window), dtype='int64')
+            self.values = np.empty((0, self.observation_window, len(self.col_list)))
+            self.min_dates = np.empty(0, dtype='datetime64[ns]')
+            self.joined_dates = np.empty(0, dtype='datetime64[ns]')
+            self.start_dates = np.empty(0, dtype='datetime64[ns]')
+            self.last_funds = np.empty(0)
+            self.attrited = np.empty(0, dtype='int8')
+        self.customer_ids = np.concatenate([self.customer_ids, np.asarray(customer_ids)])
+        self.months = np.concatenate([self.months, np.full((n, self.observation_window), -1, dtype='int64')])
+        self.values = np.concatenate([self.values, np.full((n, self.observation_window, len(self.col_list)), np.nan)])
+        self.min_dates = np.concatenate([self.min_dates, np.full(n, np.datetime64('NaT'), dtype='datetime64[ns]')])
+        self.joined_dates = np.concatenate([self.joined_dates, np.full(n, np.datetime64('NaT'), dtype='datetime64[ns]')])
+        self.start_dates = np.concatenate([self.start_dates, np.full(n, np.datetime64('NaT'), dtype='datetime64[ns]')])
+        self.last_funds = np.concatenate([self.last_funds, np.full(n, np.nan)])
+        self.attrited = np.concatenate([self.attrited, np.zeros(n, dtype='int8')])
+
+    def update(self, df):
+        # add the rows in df for the months after the latest month in the store, rows for the months already in the store are ignored
+        # so the months have to be added in order. If there is more than one row for a customer in a month the last one is kept in the ring buffer
+        if self.col_list is None:
+            self.col_list = [attribute for attribute in self.prep.derive_column_list if attribute in df.columns]
+        df = self.new_rows(df)
+        if df.shape[0] == 0:
+            return
+        new_ids = pd.unique(df[self.prep.granularity_key])
+        if self.customer_ids is not None:
+            new_ids = new_ids[pd.Index(self.customer_ids).get_indexer(new_ids) < 0]
+        if len(new_ids) > 0:
+            self.add_customers(np.array(new_ids.tolist()))
+
+        rows = pd.DataFrame({'ROW' : pd.Index(self.customer_ids).get_indexer(df[self.prep.granularity_key]),
+                             'MONTH' : df[self.prep.customer_end_date].values.astype('datetime64[M]').astype('int64')})
+        rows['SLOT'] = rows['MONTH'] % self.observation_window
+        rows['POSITION'] = np.arange(len(rows))
+        # keep only the latest month (and the last row within that month) for each customer and slot
+        rows = rows.sort_values(by=['MONTH', 'POSITION'], kind='mergesort').drop_duplicates(subset=['ROW', 'SLOT'], keep='last')
+        # don't overwrite a slot with data older than what is already there
+        rows = rows[rows['MONTH'].values >= self.months[rows['ROW'].values, rows['SLOT'].values]]
+
+        self.months[rows['ROW'].values, rows['SLOT'].values] = rows['MONTH'].values
+        self.values[rows['ROW'].values, rows['SLOT'].values] = df[self.col_list].values[rows['POSITION'].values].astype(float)
+
+        # flag the attrition of each new record as prep_customers does, the first new record of a customer follows their last record in the store
+        df_records = self.prep.filter_attributes(df)
+        df_records['AUM_reduction_threshold'] = self.prep.AUM_reduction_threshold
+        df_records = self.prep.define_attrition_monthly(df_records, pd.Series(self.last_funds, index=self.customer_ids))
+        df_customers = df_records.groupby(self.prep.granularity_key).agg(MIN_DATE=(self.prep.customer_end_date, 'min'),
+            JOINED_DATE=(self.prep.date_customer_joined, 'min'), START_DATE=(self.prep.customer_start_date, 'min'), ATTRITED=('attrition', 'max'))
+        # the funds of the last record, even if it is null, as define_attrition_monthly compares with the previous record
+        df_customers['LAST_FUNDS'] = df_records.drop_duplicates(subset=self.prep.granularity_key, keep='last').set_index(self.prep.granularity_key)[self.prep.funds_attribute]
+        row = pd.Index(self.customer_ids).get_indexer(df_customers.index)
+        self.min_dates[row] = np.fmin(self.min_dates[row], df_customers['MIN_DATE'].values.astype('datetime64[ns]'))
+        self.joined_dates[row] = np.fmin(self.joined_dates[row], df_customers['JOINED_DATE'].values.astype('datetime64[ns]'))
+        self.start_dates[row] = np.fmin(self.start_dates[row], df_customers['START_DATE'].values.astype('datetime64[ns]'))
+        self.attrited[row] = np.maximum(self.attrited[row], df_customers['ATTRITED'].values)
+        self.last_funds[row] = df_customers['LAST_FUNDS'].values
+
+        # keep the records of the last observation_window months
+        if self.records is not None:
+            df_records = pd.concat([self.records, df_records])
+        record_months = df_records[self.prep.customer_end_date].values.astype('datetime64[M]').astype('int64')
+        df_records = df_records[record_months > self.last_month() - self.observation_window]
+        self.records = df_records.sort_values(by=[self.prep.granularity_key, self.prep.customer_end_date], kind='mergesort').reset_index(drop=True)
+
+    def customer_history(self):
+        # for each customer: the date of their first record, their join date (the earliest summary start date if they have none)
+        # and whether they have attrited in any month in the store
+        return pd.DataFrame({'MIN_DATE' : self.min_dates,
+                             self.prep.date_customer_joined : pd.Series(self.joined_dates).fillna(pd.Series(self.start_dates)).values,
+                             self.prep.target_attribute : self.attrited}, index=self.customer_ids)
+
+    def summary(self, effective_date, col_list=None):
+        # return the same summary dataframe that derive_features builds for the observation window ending at effective_date
+        # the ring buffer is more than enough to get mean and std, so they are calculated from it rather than from running sums
+        # effective_date has to be a month end no earlier than the latest month in the store, older months have been overwritten
+        if col_list is None:
+            col_list = self.col_list
+        effective_date = pd.Timestamp(effective_date)
+        if not effective_date.is_month_end:
+            raise ValueError('The effective date ' + str(effective_date.date()) + ' is not the last day of a month')
+        last_month = self.last_month()
+        if last_month is None:
+            raise ValueError('The feature store is empty')
+        eff_month = np.datetime64(effective_date, 'M').astype('int64')
+        if eff_month < last_month:
+            raise ValueError('The effective date ' + str(effective_date.date()) + ' is before the latest month in the feature store, ' +
+                             str(np.datetime64(last_month, 'M')) + ', the months before it are no longer kept')
+        if eff_month - last_month >= self.observation_window:
+            raise ValueError('The feature store has no data in the observation window of the effective date ' + str(effective_date.date()) +
+                             ', its latest month is ' + str(np.datetime64(last_month, 'M')))
+        col_idx = [self.col_list.index(col) for col in col_list]
+        first_month = eff_month - self.observation_window + 1
+
+        # put the months in the window in date order for each customer, empty months are left as nan
+        in_window = (self.months >= first_month) & (self.months <= eff_month)
+        row, slot = np.nonzero(in_window)
+        values = np.full((len(self.customer_ids), self.observation_window, len(col_idx)), np.nan)
+        values[row, self.months[row, slot] - first_month] = self.values[row, slot][:, col_idx]
+        keep = in_window.any(axis=1)
+        values = values[keep]
+
+        present = ~np.isnan(values)
+        count = present.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            total = np.where(present, values, 0).sum(axis=1)
+            mean = total / count
+            std = np.sqrt(np.where(present, (values - mean[:, None, :]) ** 2, 0).sum(axis=1) / (count - 1))
+        std[count < 2] = np.nan
+        vmin = np.where(present, values, np.inf).min(axis=1)
+        vmax = np.where(present, values, -np.inf).max(axis=1)
+        # first and last non-null value in the window
+        first = np.take_along_axis(values, present.argmax(axis=1)[:, None, :], axis=1)[:, 0, :]
+        last = np.take_along_axis(values, (self.observation_window - 1 - present[:, ::-1, :].argmax(axis=1))[:, None, :], axis=1)[:, 0, :]
+        for stat in [vmin, vmax, first, last]:
+            stat[count == 0] = np.nan
+
+        # same column order as derive_features
+        df_summary = pd.DataFrame({self.prep.granularity_key : self.customer_ids[keep]})
+        stats = {'mean' : mean, 'std' : std, 'min' : vmin, 'max' : vmax, 'last' : last, 'first' : first}
+        for i, col in enumerate(col_list):
+            for stat in ['mean', 'std', 'min', 'max', 'last', 'first']:
+                df_summary[col + '_' + stat] = stats[stat][:, i]
+        df_summary = self.prep.add_window_ratios(df_summary, col_list, self.observation_window)
+        for i, col in enumerate(col_list):
+            if col in self.prep.sum_list:
+                df_summary[col + '_sum'] = total[:, i]
+        return df_summary
+
+    def save(self, path):
+        # the arrays are saved to path as an npz file and the records of the observation window to a parquet file next to it
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        np.savez(path, customer_ids=self.customer_ids, months=self.months, values=self.values,
+                 min_dates=self.min_dates, joined_dates=self.joined_dates, start_dates=self.start_dates,
+                 last_funds=self.last_funds, attrited=self.attrited,
+                 col_list=np.array(self.col_list), observation_window=self.observation_window)
+        pq.write_table(pa.Table.from_pandas(self.records, preserve_index=False), self.records_path(path))
+
+    def records_path(self, path):
+        return os.path.splitext(path)[0] + '_records.parquet'
+
+    def load(self, path):
+        import pyarrow.parquet as pq
+        with np.load(path, allow_pickle=False) as state:
+            if int(state['observation_window']) != self.observation_window:
+                raise ValueError('Feature store was built with an observation window of ' + str(int(state['observation_window'])) + 
+                                 ' months, not ' + str(self.observation_window))
+            self.customer_ids = state['customer_ids']
+            self.months = state['months']
+            self.values = state['values']
+            self.min_dates = state['min_dates']
+            self.joined_dates = state['joined_dates']
+            self.start_dates = state['start_dates']
+            self.last_funds = state['last_funds']
+            self.attrited = state['attrited']
+            self.col_list = state['col_list'].tolist()
+        self.records = pq.read_table(self.records_path(path)).to_pandas()
+        return self
+
+class ScoreCache():
+    # keeps the last probability of attrition of each customer with the customer_fingerprints hash of the history it was scored from
+    # when the customers are rescored, only those whose hash has changed (their records changed, or the effective date moved)
+    # are prepped and scored again, the others keep their cached probability
+    # the prep must have a prep_transformer so that each customer's prepped record does not depend on who they are prepped with
+    # usage:
+    #   cache = ScoreCache(prep, 'scores.parquet', model_version=model_id)
+    #   probabilities = cache.rescore(df_raw, lambda df_prepped: model.predict_proba(df_prepped)[:, 1])
+    def __init__(self, prep, path, model_version=''):
+        if prep.prep_transformer is None:
+            raise ValueError('ScoreCache needs an AttritionPrep with a prep_transformer')
+        self.prep = prep
+        self.path = path
+        self.model_version = str(model_version)
+        self.n_rescored = 0
+
+    def setup_fingerprint(self):
+        # the scores are only reused with the same prep parameters, prep script and model
+        return self.prep.prep_fingerprint(pd.DataFrame(), 'score') + self.model_version
+
+    def load(self):
+        # returns the cached fingerprints and probabilities indexed by customer ID, empty if there are none for this setup
+        import pyarrow.parquet as pq
+        if os.path.exists(self.path):
+            table = pq.read_table(self.path)
+            if (table.schema.metadata or {}).get(b'setup', b'').decode() == self.setup_fingerprint():
+                return table.to_pandas()
+        return pd.DataFrame({'FINGERPRINT' : np.array([], dtype='uint64'), 'PROBABILITY' : np.array([], dtype=float)},
+                            index=pd.Index([], name=self.prep.granularity_key))
+
+    def save(self, df_scores):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(df_scores)
+        table = table.replace_schema_metadata(dict(table.schema.metadata, setup=self.setup_fingerprint()))
+        pq.write_table(table, self.path + '.tmp')
+        os.replace(self.path + '.tmp', self.path)
+
+    def rescore(self, df_raw, score_function):
+        # score_function takes the prepped data and returns the probability of attrition for each row
+        # returns the probability for each customer in df_raw with records up to the effective date,
+        # NaN for customers who cannot be scored, e.g. they have attrited or have too few months of data
+        fingerprints = self.prep.customer_fingerprints(df_raw)
+        df_cached = self.load()
+        df_scores = pd.DataFrame({'FINGERPRINT' : fingerprints.values,
+                                  'PROBABILITY' : df_cached['PROBABILITY'].reindex(fingerprints.index).values}, index=fingerprints.index)
+
+        # compare the fingerprints of the customers in both as uint64, reindexing would turn them into floats
+        cached_customers = fingerprints.index.intersection(df_cached.index)
+        unchanged = cached_customers[df_cached.loc[cached_customers, 'FINGERPRINT'].values == fingerprints.loc[cached_customers].values]
+        changed = fingerprints.index.difference(unchanged)
+        self.n_rescored = len(changed)
+        print('Rescoring ' + str(len(changed)) + ' of ' + str(len(fingerprints)) + ' customers')
+        if len(changed) > 0:
+            df_scores.loc[changed, 'PROBABILITY'] = np.nan
+            try:
+                df_prepped = self.prep.prep_data(df_raw[df_raw[self.prep.granularity_key].isin(changed)], 'score')
+            except NoCustomersError:
+                df_prepped = None
+            if df_prepped is not None and df_prepped.shape[0] > 0:
+                df_scores.loc[df_prepped.index, 'PROBABILITY'] = np.asarray(score_function(df_prepped), dtype=float)
+
+        self.save(df_scores)
+        return df_scores['PROBABILITY']
@@ -0,0 +1,142 @@
+"""
+Sample Materials, provided under license.
+Licensed Materials - Property of IBM
+© Copyright IBM Corp. 2019. All Rights Reserved.
+US Government Users Restricted Rights - Use, duplication or disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+"""
+
+# model inference for the prepped data (the output of AttritionPrep.prep_data with train_or_score='score')
+# the scoring function in 3-model-scoring-and-app-deployment downloads and imports this script when it scores the model
+# it loads in-process (score_locally), the prep script only prepares the data
+
+import numpy as np
+import pandas as pd
+
+class CompiledEnsemble():
+    # the trees of a fitted RandomForestClassifier or GradientBoostingClassifier compiled into flat numpy arrays,
+    # with a predict_proba that walks all of the trees for all of the rows together, one level of the trees at a time
+    # sklearn predicts with one tree at a time, which is slow for the one customer or small batches that are scored in a request
+    # the probabilities are the same as the model's predict_proba, the trees are added up in the same order
+    # usage:
+    #   compiled_model = CompiledEnsemble(model)
+    #   compiled_model.save('compiled_model.npz')
+    #   probabilities = CompiledEnsemble().load('compiled_model.npz').predict_proba(df_prepped)
+    def __init__(self, model=None):
+        if model is not None:
+            self.compile(model)
+
+    def compile(self, model):
+        # the nodes of all the trees are stored one tree after another, roots holds the position of each tree's root
+        # the children of a leaf are the leaf itself, so a row that has reached a leaf stays there
+        if hasattr(model, 'init_'):
+            if model.estimators_.shape[1] != 1:
+                raise ValueError('Only gradient boosting models with two classes can be compiled')
+            if model.loss not in ['log_loss', 'deviance']:
+                raise ValueError('Only gradient boosting models with the log loss can be compiled')
+            trees = [estimator.tree_ for estimator in model.estimators_[:, 0]]
+            self.kind = 'gradient_boosting'
+            self.learning_rate = float(model.learning_rate)
+            self.init_raw_prediction = self.init_raw_prediction_of(model)
+        else:
+            trees = [estimator.tree_ for estimator in model.estimators_]
+            self.kind = 'random_forest'
+            self.learning_rate = 1.0
+            self.init_raw_prediction = 0.0
+        self.classes_ = np.asarray(model.classes_)
+        self.feature_names = [str(name) for name in getattr(model, 'feature_names_in_', [])]
+
+        n_nodes = np.array([tree.node_count for tree in trees])
+        offsets = np.concatenate([[0], np.cumsum(n_nodes)[:-1]])
+        self.roots = offsets.astype(np.int64)
+        self.max_depth = max(tree.max_depth for tree in trees)
+        self.n_features = int(model.n_features_in_)
+        self.feature = np.concatenate([np.maximum(tree.feature, 0) for tree in trees]).astype(np.int64)
+        self.threshold = np.concatenate([tree.threshold for tree in trees])
+        self.missing_go_to_left = np.concatenate([getattr(tree, 'missing_go_to_left', np.zeros(tree.node_count, dtype=np.uint8)) for tree in trees]).astype(bool)
+        # children holds the left and then the right child of each node, so the child is children[2 * node + go_right]
+        nodes = [np.arange(tree.node_count) for tree in trees]
+        left = np.concatenate([np.where(tree.children_left == -1, node, tree.children_left) + offset for tree, node, offset in zip(trees, nodes, offsets)])
+        right = np.concatenate([np.where(tree.children_right == -1, node, tree.children_right) + offset for tree, node, offset in zip(trees, nodes, offsets)])
+        self.children = np.stack([left, right], axis=1).ravel().astype(np.int64)
+
+        if self.kind == 'gradient_boosting':
+            self.value = np.concatenate([tree.value[:, 0, 0] for tree in trees])[:, np.newaxis]
+        else:
+            value = np.concatenate([tree.value[:, 0, :len(self.classes_)] for tree in trees])
+            # newer versions of sklearn store the class fractions in each node, older ones store the counts and normalise them
+            normalizer = value.sum(axis=1, keepdims=True)
+            if not np.allclose(normalizer, 1):
+                normalizer[normalizer == 0.0] = 1.0
+                value = value / normalizer
+            self.value = value
+        return self
+
+    def init_raw_prediction_of(self, model):
+        # the raw prediction of the init estimator of a gradient boosting model, which the trees are added to
+        # with the default init estimator it is the log odds of the class prior from training, the same for every row
+        from sklearn.dummy import DummyClassifier
+        from scipy.special import logit
+        if isinstance(model.init_, str) and model.init_ == 'zero':
+            return 0.0
+        if not isinstance(model.init_, DummyClassifier) or model.init_.strategy == 'stratified':
+            raise ValueError('Only gradient boosting models with an init estimator that predicts the same for every row can be compiled')
+        probability = model.init_.predict_proba(np.zeros((1, model.n_features_in_)))[0, 1]
+        # clipped as sklearn does before taking the log odds
+        eps = np.finfo(np.float64).eps
+        return float(logit(np.clip(probability, eps, 1 - eps)))
+
+    def leaves(self, X):
+        # returns the leaf that each row reaches in each tree, as an array of shape (number of trees, number of rows)
+        # index the values of X as one flat array, the value of feature f for row i is at i * n_features + f
+        X_flat = np.ascontiguousarray(X).ravel()
+        row_starts = (np.arange(X.shape[0]) * self.n_features)[np.newaxis, :]
+        node = np.repeat(self.roots[:, np.newaxis], X.shape[0], axis=1)
+        for _ in range(self.max_depth):
+            x = X_flat[row_starts + self.feature[node]]
+            # a missing value fails the comparison and goes right, unless the tree sends missing values left at that node
+            go_right = ~(x <= self.threshold[node])
+            if np.isnan(x).any():
+                go_right &= ~(np.isnan(x) & self.missing_go_to_left[node])
+            node = self.children[2 * node + go_right]
+        return node
+
+    def predict_proba(self, X):
+        # X is a dataframe with the columns the model was trained on, or an array with the columns in the same order
+        # sklearn trees compare the features as float32
+        if isinstance(X, pd.DataFrame) and len(self.feature_names) > 0:
+            X = X[self.feature_names]
+        X = np.asarray(X, dtype=np.float32)
+        leaf_values = self.value[self.leaves(X)]
+
+        # summing over the first axis adds the trees one after another, in the same order as sklearn
+        if self.kind == 'gradient_boosting':
+            raw_prediction = np.concatenate([np.full((1, X.shape[0]), self.init_raw_prediction),
+                                             self.learning_rate * leaf_values[:, :, 0]]).sum(axis=0)
+            from scipy.special import expit
+            probabilities = np.empty((X.shape[0], 2))
+            probabilities[:, 1] = expit(raw_prediction)
+            probabilities[:, 0] = 1 - probabilities[:, 1]
+            return probabilities
+        return leaf_values.sum(axis=0) / len(self.roots)
+
+    def predict(self, X):
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+    def save(self, path):
+        np.savez(path, kind=self.kind, learning_rate=self.learning_rate, init_raw_prediction=self.init_raw_prediction,
+                 classes=self.classes_, feature_names=np.array(self.feature_names, dtype=str), n_features=self.n_features,
+                 roots=self.roots, max_depth=self.max_depth, feature=self.feature, threshold=self.threshold,
+                 missing_go_to_left=self.missing_go_to_left, children=self.children, value=self.value)
+
+    def load(self, path):
+        with np.load(path, allow_pickle=False) as state:
+            self.kind = str(state['kind'])
+            self.learning_rate = float(state['learning_rate'])
+            self.init_raw_prediction = float(state['init_raw_prediction'])
+            self.classes_ = state['classes']
+            self.feature_names = state['feature_names'].tolist()
+            self.n_features = int(state['n_features'])
+            self.max_depth = int(state['max_depth'])
+            for name in ['roots', 'feature', 'threshold', 'missing_go_to_left', 'children', 'value']:
+                setattr(self, name, state[name])
+        return self
@@ -0,0 +1,134 @@
+"""
+Sample Materials, provided under license.
+Licensed Materials - Property of IBM
+© Copyright IBM Corp. 2019. All Rights Reserved.
+US Government Users Restricted Rights - Use, duplication or disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+"""
+
+# the home panel summary for the Dash dashboard, worked out from the customer history and the probabilities of attrition
+# it uses the user inputs and the monthly attrition flag of an AttritionPrep, but is not part of the prep or the scoring function
+# e.g. in 3-model-scoring-and-app-deployment after the customers are scored
+
+import pandas as pd
+import numpy as np
+import datetime
+import heapq
+import os
+import json
+
+class HomeSummary():
+    # the figures on the home panel of the dashboard, written to a small json file that the dashboard reads as it is:
+    # the number of customers who first attrited (as flagged by define_attrition_monthly) in each of the last n_months months,
+    # the number of customers in each risk level of their last probability of attrition, and the top_k customers most at risk
+    # the month each customer first attrited and their last probability are kept in a state file next to it, so when
+    # new history or scores arrive only those customers are updated. The figures are kept as running counts and a top_k list
+    # that are updated with the changes to those customers, they are only worked out from the whole state when it is loaded
+    # (or the top_k list when one of its customers' probability drops)
+    # usage:
+    #   summary = HomeSummary(prep, 'home_summary.json')
+    #   summary.update_history(df_raw)                                 # the whole history of the customers whose records changed
+    #   summary.update_scores(cache.rescore(df_raw, score_function))   # the probabilities of the customers that were scored
+    def __init__(self, prep, path, n_months=9, top_k=7, risk_thresholds=[0.3, 0.6], risk_levels=['Low Risk', 'Medium Risk', 'High Risk']):
+        if len(risk_levels) != len(risk_thresholds) + 1:
+            raise ValueError('risk_levels needs one more level than there are risk_thresholds')
+        self.prep = prep
+        self.path = path
+        self.state_path = os.path.splitext(path)[0] + '_state.parquet'
+        self.n_months = n_months
+        self.top_k = top_k
+        self.risk_thresholds = risk_thresholds
+        self.risk_levels = risk_levels
+        self.state = self.load_state()
+        self.init_aggregates()
+
+    def load_state(self):
+        # the first month of attrition and the last probability of each customer, NaT or NaN if there is none
+        if os.path.exists(self.state_path):
+            return pd.read_parquet(self.state_path)
+        return pd.DataFrame({'ATTRITION_MONTH' : pd.Series([], dtype='datetime64[ns]'), 'PROBABILITY' : pd.Series([], dtype=float)},
+                            index=pd.Index([], name=self.prep.granularity_key))
+
+    def init_aggregates(self):
+        # the number of customers who first attrited in each month, the number of customers at each risk level,
+        # and the top_k (probability, customer ID) pairs
+        self.attrition_counts = self.attrition_months(self.state['ATTRITION_MONTH']).value_counts()
+        self.risk_counts = self.risk_level_counts(self.state['PROBABILITY'])
+        self.top_clients = self.largest(self.state['PROBABILITY'])
+
+    def attrition_months(self, attrition_month):
+        return attrition_month.dropna().dt.to_period('M')
+
+    def risk_level_counts(self, probabilities):
+        probabilities = probabilities.dropna()
+        return np.bincount(np.searchsorted(self.risk_thresholds, probabilities.values, side='right'), minlength=len(self.risk_levels))
+
+    def largest(self, probabilities):
+        # the customers most at risk, from a heap of size top_k over the probabilities
+        probabilities = probabilities.dropna()
+        return heapq.nlargest(self.top_k, zip(probabilities.values, probabilities.index), key=lambda item: item[0])
+
+    def add_customers(self, customer_ids):
+        new_customers = pd.Index(customer_ids).difference(self.state.index)
+        if len(new_customers) > 0:
+            self.state = pd.concat([self.state, pd.DataFrame({'ATTRITION_MONTH' : pd.Series(pd.NaT, index=new_customers, dtype='datetime64[ns]'),
+                                                              'PROBABILITY' : pd.Series(np.nan, index=new_customers)})])
+            self.state.index.name = self.prep.granularity_key
+
+    def update_history(self, df_raw):
+        # df_raw must have every record of each customer in it, as the attrition flag compares each month with the one before
+        prep = self.prep
+        df = df_raw[[prep.granularity_key, prep.customer_end_date, prep.funds_attribute, prep.status_attribute]].copy()
+        df[prep.customer_end_date] = pd.to_datetime(df[prep.customer_end_date])
+        df = df[df[prep.customer_end_date] <= pd.Timestamp(prep.effective_date)]
+        df['AUM_reduction_threshold'] = prep.AUM_reduction_threshold
+        df = prep.define_attrition_monthly(df)
+        first_attrition = df[df['attrition'] == 1].groupby(prep.granularity_key)[prep.customer_end_date].min()
+
+        customers = pd.Index(df_raw[prep.granularity_key].unique())
+        self.add_customers(customers)
+        attrition_month = pd.Series(first_attrition.dt.to_period('M').dt.to_timestamp().reindex(customers).values, index=customers)
+        # take the customers' old months out of the counts and add their new ones
+        self.attrition_counts = self.attrition_counts.sub(self.attrition_months(self.state.loc[customers, 'ATTRITION_MONTH']).value_counts(), fill_value=0)
+        self.attrition_counts = self.attrition_counts.add(self.attrition_months(attrition_month).value_counts(), fill_value=0)
+        self.state.loc[customers, 'ATTRITION_MONTH'] = attrition_month.values
+        self.save()
+
+    def update_scores(self, probabilities):
+        # probabilities is indexed by customer ID, NaN for customers who could not be scored
+        self.add_customers(probabilities.index)
+        probabilities = pd.Series(np.asarray(probabilities, dtype=float), index=probabilities.index)
+        old_probabilities = self.state.loc[probabilities.index, 'PROBABILITY']
+        self.risk_counts = self.risk_counts - self.risk_level_counts(old_probabilities) + self.risk_level_counts(probabilities)
+        self.state.loc[probabilities.index, 'PROBABILITY'] = probabilities.values
+
+        # a customer outside the top_k can only take the place of one in it if one of the top_k customers' probability has dropped,
+        # otherwise the new top_k are among the old ones and the customers that were scored
+        old_top = dict((customer_id, probability) for probability, customer_id in self.top_clients)
+        if any(customer_id in old_top and not probability >= old_top[customer_id] for customer_id, probability in probabilities.items()):
+            self.top_clients = self.largest(self.state['PROBABILITY'])
+        else:
+            candidates = [(probability, customer_id) for probability, customer_id in self.top_clients if customer_id not in probabilities.index]
+            self.top_clients = heapq.nlargest(self.top_k, candidates + self.largest(probabilities), key=lambda item: item[0])
+        self.save()
+
+    def summary(self):
+        # made from the running counts and top_k list, so it does not depend on the number of customers
+        months = pd.period_range(end=pd.Timestamp(self.prep.effective_date).to_period('M'), periods=self.n_months, freq='M')
+        monthly_attrition = self.attrition_counts.reindex(months, fill_value=0)
+        risk_counts = self.risk_counts
+        top_clients = self.top_clients
+        return {'effective_date' : str(pd.Timestamp(self.prep.effective_date).date()),
+                'updated' : datetime.datetime.now().isoformat(timespec='seconds'),
+                'monthly_attrition' : {'month' : [str(month) for month in months], 'customers' : [int(n) for n in monthly_attrition.values]},
+                'risk' : {'level' : self.risk_levels, 'customers' : [int(n) for n in risk_counts]},
+                'top_clients' : [{'customer_id' : customer_id.item() if hasattr(customer_id, 'item') else customer_id,
+                                  'probability' : float(probability),
+                                  'risk' : self.risk_levels[np.searchsorted(self.risk_thresholds, probability, side='right')]}
+                                 for probability, customer_id in top_clients]}
+
+    def save(self):
+        self.state.to_parquet(self.state_path + '.tmp')
+        os.replace(self.state_path + '.tmp', self.state_path)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        os.replace(self.path + '.tmp', self.path)
@@ -0,0 +1,160 @@
+"""
+Sample Materials, provided under license.
+Licensed Materials - Property of IBM
+© Copyright IBM Corp. 2019. All Rights Reserved.
+US Government Users Restricted Rights - Use, duplication or disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+"""
+
+# model training for the prepped training data (training_data.csv saved by 1-data-preprocessing)
+# fit_candidates fits candidate models at the same time in separate processes and records the fit time, peak memory
+# and test scores of each. successive_halving searches over candidate settings for the tree ensembles, giving more trees or
+# boosting stages only to the best candidates of each round and growing them with warm_start instead of refitting them
+# e.g. python attrition_training.py training_data.csv --search --workers 4 --output training_results.json --model-output model.pkl
+
+import pandas as pd
+import argparse
+import concurrent.futures
+import datetime
+import json
+import math
+import pickle
+import time
+import tracemalloc
+
+from sklearn.base import clone
+from sklearn.model_selection import train_test_split
+from sklearn.linear_model import LogisticRegression
+from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier
+from sklearn import metrics
+
+def load_training_data(path, target_attribute='TARGET', test_size=0.20, random_state=1234):
+    # reads the prepped training data and splits it into train and test data as in 2-model-training
+    # returns X_train, X_test, y_train, y_test
+    df_prepped = pd.read_csv(path)
+    X_inputs = df_prepped.drop([target_attribute], axis=1)
+    y_output = df_prepped[target_attribute]
+    return train_test_split(X_inputs, y_output, stratify=y_output, test_size=test_size, random_state=random_state)
+
+def default_candidates(random_state=1234):
+    # the models fitted in 2-model-training
+    return {'Logistic Regression' : LogisticRegression(penalty='l1', solver='saga', tol=0.1),
+            'Random Forest' : RandomForestClassifier(n_estimators=500, max_depth=9, random_state=random_state),
+            'Gradient Boosting' : GradientBoostingClassifier(learning_rate=0.01, n_estimators=500, max_depth=12, random_state=random_state)}
+
+def search_candidates(random_state=1234):
+    # settings of the random forest and gradient boosting models to search over with successive_halving
+    # the gradient boosting models stop adding stages early when 10 stages in a row don't improve the score
+    # on the 10% of the training data they hold out
+    candidates = {}
+    for max_depth in [6, 9, 12]:
+        for max_features in ['sqrt', 0.5]:
+            candidates['Random Forest max_depth=' + str(max_depth) + ' max_features=' + str(max_features)] = RandomForestClassifier(
+                max_depth=max_depth, max_features=max_features, random_state=random_state)
+    for learning_rate in [0.01, 0.05, 0.1]:
+        for max_depth in [3, 6, 12]:
+            candidates['Gradient Boosting learning_rate=' + str(learning_rate) + ' max_depth=' + str(max_depth)] = GradientBoostingClassifier(
+                learning_rate=learning_rate, max_depth=max_depth, n_iter_no_change=10, validation_fraction=0.1, random_state=random_state)
+    return candidates
+
+def model_params(model):
+    # the settings of the model that can be written to json
+    return {key : value for key, value in model.get_params().items() if isinstance(value, (int, float, str, bool, type(None)))}
+
+def fit_candidate(name, model, X_train, y_train, X_test, y_test):
+    # fits one candidate and returns the fitted model with its fit time, its peak memory while fitting
+    # and its accuracy and area under the ROC curve on the test data
+    # the peak memory is what tracemalloc sees, the python objects and numpy arrays but not the memory sklearn allocates in C
+    tracemalloc.start()
+    start = time.perf_counter()
+    model.fit(X_train, y_train)
+    fit_seconds = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    probabilities = model.predict_proba(X_test)[:, 1]
+    return {'name' : name, 'params' : model_params(model), 'n_estimators' : len(getattr(model, 'estimators_', [])) or None,
+            'fit_seconds' : fit_seconds, 'peak_memory_mb' : peak_memory / 2**20,
+            'accuracy' : metrics.accuracy_score(y_test, model.predict(X_test)),
+            'roc_auc' : metrics.roc_auc_score(y_test, probabilities), 'model' : model}
+
+def fit_candidates(candidates, X_train, y_train, X_test, y_test, max_workers=None):
+    # fits each of the candidates (a dictionary of name : model) in its own process, max_workers at a time
+    # returns the fit_candidate results in the same order as the candidates
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fit_candidate, name, model, X_train, y_train, X_test, y_test) for name, model in candidates.items()]
+        return [future.result() for future in futures]
+
+def successive_halving(candidates, X_train, y_train, min_estimators=50, max_estimators=500, factor=3,
+                       validation_size=0.20, random_state=1234, max_workers=None):
+    # successive halving search over candidate random forest and gradient boosting models (a dictionary of name : model)
+    # every candidate is fitted with min_estimators trees or boosting stages on part of the training data and scored
+    # on the validation_size that is held out. The best 1 / factor of them get factor times as many trees, until one
+    # candidate is left or they have max_estimators. Each round adds the new trees to the candidate's fitted model with
+    # warm_start rather than fitting them all again. The candidates are cloned, so the models passed in are left unchanged
+    # returns the best candidate's fit_candidate result, and the results of every candidate in every round
+    for name, model in candidates.items():
+        if 'n_estimators' not in model.get_params() or 'warm_start' not in model.get_params():
+            raise ValueError(name + ' does not have n_estimators and warm_start, so it can not be used for successive halving')
+    X_fit, X_validation, y_fit, y_validation = train_test_split(X_train, y_train, stratify=y_train,
+                                                                test_size=validation_size, random_state=random_state)
+
+    remaining = {name : clone(model) for name, model in candidates.items()}
+    n_estimators = min_estimators
+    rounds = []
+    while True:
+        for model in remaining.values():
+            model.set_params(n_estimators=n_estimators, warm_start=True)
+        results = fit_candidates(remaining, X_fit, y_fit, X_validation, y_validation, max_workers)
+        for result in results:
+            result['round'] = len(rounds)
+        rounds.append(results)
+        print('Round ' + str(len(rounds)) + ': ' + str(len(results)) + ' candidates with ' + str(n_estimators) + ' estimators, best '
+              + max(results, key=lambda result: result['roc_auc'])['name'])
+
+        results = sorted(results, key=lambda result: result['roc_auc'], reverse=True)
+        if len(results) == 1 or n_estimators >= max_estimators:
+            break
+        # the fitted models come back from the worker processes, keep growing those
+        remaining = {result['name'] : result['model'] for result in results[:max(1, math.ceil(len(results) / factor))]}
+        n_estimators = min(n_estimators * factor, max_estimators)
+
+    return results[0], [result for round_results in rounds for result in round_results]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit the attrition models on the prepped training data')
+    parser.add_argument('training_data', help='the prepped training data csv saved by 1-data-preprocessing')
+    parser.add_argument('--search', action='store_true', help='run the successive halving search instead of fitting the default models')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes to fit candidates in, default is the number of CPUs')
+    parser.add_argument('--min-estimators', type=int, default=50)
+    parser.add_argument('--max-estimators', type=int, default=500)
+    parser.add_argument('--factor', type=int, default=3)
+    parser.add_argument('--output', default='attrition_training_results.json')
+    parser.add_argument('--model-output', default=None, help='pickle the best model to this path')
+    args = parser.parse_args()
+
+    X_train, X_test, y_train, y_test = load_training_data(args.training_data)
+    if args.search:
+        best, candidate_results = successive_halving(search_candidates(), X_train, y_train, args.min_estimators, args.max_estimators,
+                                                     args.factor, max_workers=args.workers)
+        # score the best candidate on the test data, which the search has not seen
+        best_model = best['model']
+        best['test_accuracy'] = metrics.accuracy_score(y_test, best_model.predict(X_test))
+        best['test_roc_auc'] = metrics.roc_auc_score(y_test, best_model.predict_proba(X_test)[:, 1])
+    else:
+        candidate_results = fit_candidates(default_candidates(), X_train, y_train, X_test, y_test, args.workers)
+        best = max(candidate_results, key=lambda result: result['roc_auc'])
+        best_model = best['model']
+
+    results = {'created' : datetime.datetime.now().isoformat(), 'training_rows' : int(X_train.shape[0]), 'test_rows' : int(X_test.shape[0]),
+               'best' : {key : value for key, value in best.items() if key != 'model'},
+               'candidates' : [{key : value for key, value in result.items() if key != 'model'} for result in candidate_results]}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.model_output is not None:
+        with open(args.model_output, 'wb') as f:
+            pickle.dump(best_model, f)
+
+    for result in candidate_results:
+        print(result['name'] + ': ' + str(round(result['fit_seconds'], 2)) + 's, peak memory ' + str(round(result['peak_memory_mb'], 1))
+              + 'MB, accuracy ' + str(round(result['accuracy'], 4)) + ', roc auc ' + str(round(result['roc_auc'], 4)))
+    print('Best model: ' + best['name'])
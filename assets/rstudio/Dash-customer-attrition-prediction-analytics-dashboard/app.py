@@ -10,7 +10,7 @@ from lib.load_data import load_data
 from lib.icp4d_api import cp4d_api_function
 
 # Import panels
-from homePanel import home_panel_layout,
+from homePanel import home_panel_layout
 from clientPanel import client_layout
 from clientPanel import update_client_view, authenticate_api, reauthenticate_api, enable_score_btn, score_model_deployment
 
@@ -20,7 +20,7 @@ from clientPanel import update_client_view, authenticate_api, reauthenticate_api
 
 
 
-# Load the data
+# Load the data, nothing is read from the CSV files until a panel uses it
 data = load_data()
 
 # Define the layout
@@ -76,7 +76,7 @@ layout = dbc.NavbarContainer(
 )
 def render_tab_content(active_tab):
     if active_tab == "home":
-        return homePanel_layout()
+        return home_panel_layout()
     elif active_tab == "client":
         return client_panel_layout(data)
 
@@ -1,9 +1,16 @@
 from lib.icp4d_api import cp4d_api_function
+from lib.jobs import JobQueue
 from lib.load_data import load_data
+from lib.panel_cache import PanelCache
+from lib.sessions import Sessions
 import dash
+import hashlib
+import json
 import dash_html_components as html
 import dash_core_components as dcc
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
+import plotly.graph_objects as go
 
 # Import necessary libraries
 import pandas as pd
@@ -12,12 +19,24 @@ import pandas as pd
 
 
 
-# Load the data
+# Load the data, the CSV files are read when the client view first needs them
 data = load_data()
+panel_cache = PanelCache()
+
+# the calls to the Cloud Pak for Data API run as background jobs, polled by the authPoll and scoringPoll intervals
+jobs = JobQueue()
+# the API client and deployments of each browser session, looked up by the key in the sessionKey store
+sessions = Sessions()
 
 # Define the layout
 client_layout = html.Div(
     [
+        dcc.Store(id="selectedClientId", data=1103),
+        dcc.Store(id="sessionKey", storage_type="session"),
+        dcc.Store(id="authJob"),
+        dcc.Interval(id="authPoll", interval=500, disabled=True),
+        dcc.Store(id="scoringJob"),
+        dcc.Interval(id="scoringPoll", interval=500, disabled=True),
         dcc.Tabs(
             [
                 dcc.Tab(label="Client View", value="clientPanel", children=[
@@ -156,6 +175,105 @@ client_layout = html.Div(
 # Define the callbacks
 
 
+def render_client_view(client_id):
+    # look up the client in the indexed data rather than filtering the whole files
+    client = data.client(client_id)
+    if client is None:
+        return None
+
+    customer_name = client["name"]
+    customer_image = html.Img(
+        src="profiles/" + client["image"],
+        style={"display": "block", "margin-left": "auto",
+               "margin-right": "auto"},
+        width=150,
+        height=150
+    )
+
+    customer_info = html.Ul(
+        className="list-unstyled",
+        children=[
+            html.Li([
+                html.Strong("Age: "),
+                html.Span(client["age_range"], className="pull-right",),
+                " years old"
+            ]),
+            html.Li([html.Strong("Marital Status: "), html.Span(
+                client["marital_status"], className="pull-right")]),
+            html.Li([html.Strong("Address: "), html.Span(
+                client["address"], className="pull-right")]),
+            html.Li([html.Strong("Profession: "), html.Span(
+                client["profession"], className="pull-right")]),
+            html.Li([html.Strong("Level of Education: "), html.Span(
+                client["education_level"], className="pull-right")])
+        ]
+    )
+
+    customer_finances_info = html.Ul(
+        className="list-unstyled",
+        children=[
+            html.Li([html.Strong("Annual income: "), html.Span(
+                client["annual_income"], className="pull-right")]),
+            html.Li([html.Strong("Home Owner: "), html.Span(
+                "Yes" if client["home_owner_indicator"] else "No", className="pull-right")]),
+            html.Li([html.Strong("Monthly Housing: "), html.Span(
+                client["monthly_housing_cost"], className="pull-right")]),
+            html.Li([html.Strong("Credit Score: "), html.Span(
+                round(client["credit_score"], 0), className="pull-right")]),
+            html.Li([html.Strong("Credit Authority Level: "), html.Span(
+                client["credit_authority_level"], className="pull-right")])
+        ]
+    )
+
+    customer_accounts_table = html.Table(
+        className="table",
+        children=[
+            html.Thead(
+                html.Tr(
+                    [html.Th(col) for col in ["Account ID", "Account Type", "Product ID", "Base Currency",
+                                              "Investment Objective", "Life Cycle Status", "Risk Tolerance", "Tax Advantage Indicator"]]
+                )
+            ),
+            html.Tbody(
+                [
+                    html.Tr(
+                        [html.Td(client["account"].get(col, "")) for col in ["account_id", "account_type", "product_id", "base_currency",
+                                                                       "investment_objective", "life_cycle_status", "risk_tolerance", "tax_advantage_indicator"]]
+                    )
+                ]
+            )
+        ]
+    )
+
+    customer_account_summary_table = html.Table(
+        className="table",
+        children=[
+            html.Thead(
+                html.Tr(
+                    [html.Th(col) for col in ["Closing Balance", "Amount of Deposits", "Amount of Interest Earned",
+                                              "Number of Buy Trades", "Amount of Buy Trades", "Amount of Market Change"]]
+                )
+            ),
+            html.Tbody(
+                [
+                    html.Tr(
+                        [html.Td(client["account_summary"].get(col, "")) for col in ["closing_balance", "amount_of_deposits",
+                                                                               "amount_of_interest_earned", "number_of_buy_trades", "amount_of_buy_trades", "amount_of_market_change"]]
+                    )
+                ]
+            )
+        ]
+    )
+
+    pipeline_input = html.Pre(
+        json.dumps(
+            {"cust_id": client["id"], "sc_end_date": "2018-09-30"}, indent=2),
+        id="pipelineInput"
+    )
+
+    return customer_name, customer_image, customer_info, customer_finances_info, customer_accounts_table, customer_account_summary_table, pipeline_input
+
+
 @app.callback(
     Output("customerName", "children"),
     Output("customerImage", "children"),
@@ -164,109 +282,28 @@ client_layout = html.Div(
     Output("customerAccountsTable", "children"),
     Output("customerAccountSummaryTable", "children"),
     Output("pipelineInput", "children"),
-    [Input("tabs", "value")],
+    [Input("tabs", "value"), Input("selectedClientId", "data")],
     [State("tabs", "value")]
 )
-def update_client_view(selected_tab, current_tab):
+def update_client_view(selected_tab, selected_client_id, current_tab):
     if selected_tab == "clientPanel":
-        client = data["client"]
-
-        customer_name = client["name"]
-        customer_image = html.Img(
-            src="profiles/" + client["image"],
-            style={"display": "block", "margin-left": "auto",
-                   "margin-right": "auto"},
-            width=150,
-            height=150
-        )
-
-        customer_info = html.Ul(
-            className="list-unstyled",
-            children=[
-                html.Li([
-                    html.Strong("Age: "),
-                    html.Span(client["age_range"], className="pull-right",),
-                    " years old"
-                ]),
-                html.Li([html.Strong("Marital Status: "), html.Span(
-                    client["marital_status"], className="pull-right")]),
-                html.Li([html.Strong("Address: "), html.Span(
-                    client["address"], className="pull-right")]),
-                html.Li([html.Strong("Profession: "), html.Span(
-                    client["profession"], className="pull-right")]),
-                html.Li([html.Strong("Level of Education: "), html.Span(
-                    client["education_level"], className="pull-right")])
-            ]
-        )
-
-        customer_finances_info = html.Ul(
-            className="list-unstyled",
-            children=[
-                html.Li([html.Strong("Annual income: "), html.Span(
-                    client["annual_income"], className="pull-right")]),
-                html.Li([html.Strong("Home Owner: "), html.Span(
-                    "Yes" if client["home_owner_indicator"] else "No", className="pull-right")]),
-                html.Li([html.Strong("Monthly Housing: "), html.Span(
-                    client["monthly_housing_cost"], className="pull-right")]),
-                html.Li([html.Strong("Credit Score: "), html.Span(
-                    round(client["credit_score"], 0), className="pull-right")]),
-                html.Li([html.Strong("Credit Authority Level: "), html.Span(
-                    client["credit_authority_level"], className="pull-right")])
-            ]
-        )
-
-        customer_accounts_table = html.Table(
-            className="table",
-            children=[
-                html.Thead(
-                    html.Tr(
-                        [html.Th(col) for col in ["Account ID", "Account Type", "Product ID", "Base Currency",
-                                                  "Investment Objective", "Life Cycle Status", "Risk Tolerance", "Tax Advantage Indicator"]]
-                    )
-                ),
-                html.Tbody(
-                    [
-                        html.Tr(
-                            [html.Td(customer["account"][col]) for col in ["account_id", "account_type", "product_id", "base_currency",
-                                                                           "investment_objective", "life_cycle_status", "risk_tolerance", "tax_advantage_indicator"]]
-                        )
-                    ]
-                )
-            ]
-        )
+        # the rendered view is shared by the worker processes until the files it was rendered from change
+        view = panel_cache.get_or_render(selected_client_id, data.version(), lambda: render_client_view(selected_client_id))
+        if view is not None:
+            return view
 
-        customer_account_summary_table = html.Table(
-            className="table",
-            children=[
-                html.Thead(
-                    html.Tr(
-                        [html.Th(col) for col in ["Closing Balance", "Amount of Deposits", "Amount of Interest Earned",
-                                                  "Number of Buy Trades", "Amount of Buy Trades", "Amount of Market Change"]]
-                    )
-                ),
-                html.Tbody(
-                    [
-                        html.Tr(
-                            [html.Td(customer["account_summary"][col]) for col in ["closing_balance", "amount_of_deposits",
-                                                                                   "amount_of_interest_earned", "number_of_buy_trades", "amount_of_buy_trades", "amount_of_market_change"]]
-                        )
-                    ]
-                )
-            ]
-        )
+    return "", "", "", "", "", "", ""
 
-        pipeline_input = html.Pre(
-            json.dumps(
-                {"cust_id": client["id"], "sc_end_date": "2018-09-30"}, indent=2),
-            id="pipelineInput"
-        )
 
-        return customer_name, customer_image, customer_info, customer_finances_info, customer_accounts_table, customer_account_summary_table, pipeline_input
-
-    return "", "", "", "", "", "", ""
+def triggered_by(component_id):
+    # whether the callback was called because a property of the component changed
+    return any(trigger["prop_id"].split(".")[0] == component_id for trigger in dash.callback_context.triggered)
 
 
 @app.callback(
+    Output("authJob", "data"),
+    Output("sessionKey", "data"),
+    Output("authPoll", "disabled"),
     Output("space_name", "children"),
     Output("deployment_guid", "children"),
     Output("scoring_url", "children"),
@@ -275,28 +312,43 @@ def update_client_view(selected_tab, current_tab):
     Output("authPanel", "style"),
     Output("deploymentSelector", "options"),
     Output("deploymentSelector", "value"),
-    [Input("authBtn", "n_clicks")],
-    [State("hostname", "value"), State("username", "value"), State(
-        "password", "value"), State("deploymentSelector", "value")]
+    [Input("authBtn", "n_clicks"), Input("authPoll", "n_intervals")],
+    [State("authJob", "data"), State("sessionKey", "data"), State("hostname", "value"), State("username", "value"),
+     State("password", "value"), State("deploymentSelector", "value")]
 )
-def authenticate_api(n_clicks, hostname, username, password, deployment_selector):
-    if n_clicks == 0:
-        return "", "", "", {"display": "none"}, "", "", [], ""
-
-    # Authenticate API here
-    try:
-        deployments_resp = cp4d_api_function(
-            hostname, username, password, "Customer-Attrition-Prediction-Scoring-Function-Deployment")
-        deployments = deployments_resp["deployments"]
-        token = deployments_resp["token"]
-    except Exception as e:
-        return "", "", "", {"display": "none"}, str(e), "", [], ""
+def authenticate_api(n_clicks, n_intervals, job_id, session_key, hostname, username, password, deployment_selector):
+    # the button submits the authentication as a job, then each tick of authPoll checks it until it is done
+    no_update = dash.no_update
+    if triggered_by("authBtn"):
+        if n_clicks == 0:
+            return None, no_update, True, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update
+
+        # Authenticate API in the background and poll for the deployments
+        # a hash of the password is part of the key, so retyping a wrong password starts a new job instead of polling the failing one
+        session_key = session_key or Sessions.new_key()
+        password_hash = hashlib.sha256((password or "").encode()).hexdigest()
+        job_id = jobs.submit(("authenticate", session_key, hostname, username, password_hash), cp4d_api_function,
+                             hostname, username, password, "Customer-Attrition-Prediction-Scoring-Function-Deployment")
+        return job_id, session_key, False, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update
+
+    if job_id is None or session_key is None:
+        raise PreventUpdate
+
+    status = jobs.status(job_id)
+    if status["state"] == "running":
+        raise PreventUpdate
+    if status["state"] != "done":
+        return no_update, no_update, True, "", "", "", {"display": "none"}, status["error"], "", [], ""
+
+    deployments = status["result"]["deployments"]
+    sessions.set(session_key, client=status["result"]["client"], deployments=deployments)
 
     deployment_options = [{"label": deployment, "value": deployment}
                           for deployment in deployments]
-    deployment_value = deployment_selector if deployment_selector in deployments else ""
+    deployment_value = deployment_selector if deployment_selector in deployments else next(iter(deployments))
 
-    return deployments[deployment_value]["space_name"], deployments[deployment_value]["guid"], deployments[deployment_value]["scoring_url"], {}, "", {"max-width": "360px"}, deployment_options, deployment_value
+    return (no_update, no_update, True, deployments[deployment_value]["space_name"], deployments[deployment_value]["guid"],
+            deployments[deployment_value]["scoring_url"], {}, "", {"max-width": "360px"}, deployment_options, deployment_value)
 
 
 @app.callback(
@@ -322,51 +374,92 @@ def enable_score_btn(deployment_selector, token, all_customers_rows_selected):
     return {}
 
 
+def get_prob_plot(prob_df):
+    return dcc.Graph(
+        figure=go.Figure(
+            data=[
+                go.Pie(
+                    labels=prob_df["Prediction"],
+                    values=prob_df["Probability"],
+                    hovertext=prob_df["Hover Text"],
+                    hoverinfo="text",
+                    textinfo="none",
+                    hole=0.6,
+                    sort=False
+                )
+            ],
+            layout=go.Layout(
+                annotations=[{"text": prob_df.loc[prob_df["Prediction"] == "TRUE", "Percentage"].iloc[0],
+                              "showarrow": False, "font": {"size": 32}}],
+                legend={"title": "Prediction", "traceorder": "reversed"}
+            )
+        ),
+        style={"width": "600px", "height": "300px"}
+    )
+
+
 @app.callback(
+    Output("scoringJob", "data"),
     Output("scoringResponse", "children"),
     Output("scoringError", "children"),
-    [Input("scoreBtn", "n_clicks"), Input("deploymentSelector", "value"), Input(
-        "token", "value"), Input("allCustomers_rows_selected", "children")]
+    Output("scoringPoll", "disabled"),
+    [Input("scoreBtn", "n_clicks"), Input("scoringPoll", "n_intervals")],
+    [State("scoringJob", "data"), State("sessionKey", "data"), State("deploymentSelector", "value"), State("selectedClientId", "data")]
 )
-def score_model_deployment(n_clicks, deployment_selector, token, all_customers_rows_selected):
-    if n_clicks == 0:
-        return [], ""
-
-    selected_deployment = deployments[deployment_selector]
-
-    payload = {
-        "fields": ["CUSTOMER_ID", "sc_end_date"],
-        "values": [[all_customers_rows_selected, "2018-09-30"]]
-    }
-
-    try:
-        response = scoreModelDeployment(
-            selected_deployment["scoring_url"], payload, token)
-
-        if "error" in response:
-            return [], response["error"]
-        elif "predictions" in response:
-            result = response["predictions"][0]["values"]["predictions"][0]
-
-            # Generate probability pie
-            prob_values = result["values"][1]
-            prob_df = pd.DataFrame(prob_values, columns=[
-                                   "Probability"]).transpose()
-            prob_df.columns = ["Prediction"]
-            prob_df["Percentage"] = (
-                prob_df["Probability"] * 100).round(1).astype(str) + "%"
-            prob_df["Hover Text"] = prob_df["Prediction"] + \
-                ": " + prob_df["Percentage"]
-
-            prob_plot = get_prob_plot(prob_df)
-
-            return [
-                html.H3("Customer Attrition Prediction:"),
-                html.P(prob_plot),
-                html.Pre(json.dumps(result, indent=2), id="pipelineInput"),
-            ], ""
-    except Exception as e:
-        return [], str(e)
+def score_model_deployment(n_clicks, n_intervals, job_id, session_key, deployment_selector, selected_client_id):
+    # the button submits the scoring as a job, then each tick of scoringPoll checks it until it is done
+    no_update = dash.no_update
+    if triggered_by("scoreBtn"):
+        if n_clicks == 0:
+            return None, no_update, no_update, True
+        session = sessions.get(session_key)
+        if session is None:
+            return None, [], "The session has expired, please authenticate again.", True
+        if deployment_selector not in session["deployments"]:
+            return None, no_update, no_update, True
+
+        scoring_url = session["deployments"][deployment_selector]["scoring_url"]
+        payload = {
+            "fields": ["CUSTOMER_ID", "sc_end_date"],
+            "values": [[selected_client_id, "2018-09-30"]]
+        }
+
+        # score in the background, clicking again while the customer is being scored polls the same job
+        # the session's client reuses its connection to the server and authenticates again if the token has expired
+        job_id = jobs.submit(("score", session_key, scoring_url, selected_client_id), session["client"].score,
+                             scoring_url, payload)
+        return job_id, no_update, no_update, False
+
+    if job_id is None:
+        raise PreventUpdate
+
+    status = jobs.status(job_id)
+    if status["state"] == "running":
+        raise PreventUpdate
+    if status["state"] != "done":
+        return no_update, [], status["error"], True
+
+    response = status["result"]
+    if "error" in response:
+        return no_update, [], str(response["error"]), True
+
+    result = response["predictions"][0]["values"]["predictions"][0]
+
+    # Generate probability pie
+    prob_df = pd.DataFrame({"Prediction": ["FALSE", "TRUE"],
+                            "Probability": result["values"][0][1]})
+    prob_df["Percentage"] = (
+        prob_df["Probability"] * 100).round(1).astype(str) + "%"
+    prob_df["Hover Text"] = prob_df["Prediction"] + \
+        ": " + prob_df["Percentage"]
+
+    prob_plot = get_prob_plot(prob_df)
+
+    return no_update, [
+        html.H3("Customer Attrition Prediction:"),
+        html.P(prob_plot),
+        html.Pre(json.dumps(result, indent=2)),
+    ], "", True
 
 
 if __name__ == "__main__":
@@ -4,6 +4,8 @@ import dash_html_components as html
 import plotly.graph_objects as go
 import pandas as pd
 
+from lib.load_data import clients, load_home_summary
+
 
 
 # Define the client button component
@@ -40,69 +42,70 @@ def client_button(id, name, risk, image):
 
 
 # Define the home panel layout
-home_panel_layout = html.Div(
-    [
-        html.H2("Top Action Clients"),
-        html.Br(),
-        html.Div(
+# The figures are read from the summary that HomeSummary in attrition_summary.py writes when customers are scored,
+# so the panel only reads a small file rather than going over the customer history
+def home_panel_layout():
+    summary = load_home_summary()
+    if summary is None:
+        return html.Div(
             [
-                client_button(
-                    id, clients[id]["name"], clients[id]["risk"], f"profiles/{clients[id]['image']}")
-                for id in clientIds
+                html.H2("Top Action Clients"),
+                html.P("The home panel summary has not been created yet. It is written by HomeSummary in attrition_summary.py when the customers are scored.")
             ]
-        ),
-        html.H2("Monthly Customer Attrition"),
-        dcc.Graph(
-            figure=go.Figure(
-                data=[
-                    go.Bar(
-                        x=["January", "February", "March", "April",
-                            "May", "June", "July", "August", "September"],
-                        y=[4, 10, 9, 11, 13, 10, 8, 12, 9],
-                        text=[4, 10, 9, 11, 13, 10, 8, 12, 9],
-                        textposition="outside",
-                        marker_color="steelblue"
-                    )
-                ],
-                layout=go.Layout(
-                    xaxis={"title": "Month"},
-                    yaxis={"title": "Customers Attrited"},
-                    barmode="stack"
-                )
-            ),
-            style={"width": "600px", "height": "400px"}
-        ),
-        html.H2("Customers Attrition Risk"),
-        dcc.Graph(
-            figure=go.Figure(
-                data=[
-                    go.Pie(
-                        labels=["Low Risk", "Medium Risk", "High Risk"],
-                        values=[302, 135, 42],
-                        textinfo="label+percent",
-                        hole=0.3
-                    )
-                ],
-                layout=go.Layout(legend={"title": "Risk Level"})
-            ),
-            style={"width": "600px", "height": "400px"}
         )
-    ]
-)
 
-# Load the data and client information
-clients = {
-    "1": {"name": "Client 1", "risk": "Low", "image": "client1.png"},
-    "2": {"name": "Client 2", "risk": "Medium", "image": "client2.png"},
-    "3": {"name": "Client 3", "risk": "High", "image": "client3.png"}
-}
-clientIds = list(clients.keys())
-
-# Set up the app layout
-layout = html.Div(
-    [
-        html.H1("Dashboard"),
-        home_panel
-    ]
-)
+    top_clients = summary["top_clients"]
+    monthly_attrition = summary["monthly_attrition"]
+    months = [pd.Period(month).strftime("%B") for month in monthly_attrition["month"]]
 
+    return html.Div(
+        [
+            html.H2("Top Action Clients"),
+            html.Br(),
+            html.Div(
+                [
+                    client_button(
+                        top_client["customer_id"],
+                        clients.get(top_client["customer_id"], {}).get("name", f"Customer {top_client['customer_id']}"),
+                        top_client["risk"],
+                        f"profiles/{clients.get(top_client['customer_id'], {}).get('image', '')}")
+                    for top_client in top_clients
+                ]
+            ),
+            html.H2("Monthly Customer Attrition"),
+            dcc.Graph(
+                figure=go.Figure(
+                    data=[
+                        go.Bar(
+                            x=months,
+                            y=monthly_attrition["customers"],
+                            text=monthly_attrition["customers"],
+                            textposition="outside",
+                            marker_color="steelblue"
+                        )
+                    ],
+                    layout=go.Layout(
+                        xaxis={"title": "Month"},
+                        yaxis={"title": "Customers Attrited"},
+                        barmode="stack"
+                    )
+                ),
+                style={"width": "600px", "height": "400px"}
+            ),
+            html.H2("Customers Attrition Risk"),
+            dcc.Graph(
+                figure=go.Figure(
+                    data=[
+                        go.Pie(
+                            labels=summary["risk"]["level"],
+                            values=summary["risk"]["customers"],
+                            textinfo="label+percent",
+                            hole=0.3
+                        )
+                    ],
+                    layout=go.Layout(legend={"title": "Risk Level"})
+                ),
+                style={"width": "600px", "height": "400px"}
+            )
+        ]
+    )
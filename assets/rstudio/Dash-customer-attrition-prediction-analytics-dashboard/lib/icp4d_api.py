@@ -0,0 +1,196 @@
+# Sample Materials, provided under license.
+# Licensed Materials - Property of IBM
+# © Copyright IBM Corp. 2019, 2020. All Rights Reserved.
+# US Government Users Restricted Rights - Use, duplication or disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+
+# Cloud Pak for Data API functions, the Python port of lib/icp4d-api.R
+# A CP4DClient keeps one user's connections to the server open between calls, reuses their bearer token until it
+# expires, and caches the spaces and deployments for catalog_ttl seconds, fetching the two of them at the same time.
+# Every request has a timeout so that a slow or unreachable server fails the call instead of hanging it.
+# The hostname can be an http:// url, e.g. of a local stub server for testing
+
+import base64
+import datetime
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# seconds to wait for the server to connect and to respond
+TIMEOUT = (5, 30)
+SCORING_TIMEOUT = (5, 8)
+
+# fetches the spaces and deployments of a catalog at the same time
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cp4d-api")
+
+
+def base_url(hostname):
+    if not hostname.startswith("https://") and not hostname.startswith("http://"):
+        hostname = "https://" + hostname
+    return hostname.rstrip("/")
+
+
+def new_session(pool_size=10):
+    # a session whose connections are kept alive and reused by later requests to the same host
+    session = requests.Session()
+    session.verify = False
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def token_expiry(token, margin=60, default_ttl=3600):
+    # when to stop using the token: margin seconds before the exp claim of the JWT,
+    # or default_ttl seconds from now if it does not have one
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"]) - margin
+    except (IndexError, ValueError, KeyError, TypeError):
+        return time.time() + default_ttl
+
+
+def parse_deployments(spaces, deployments, target_tag=None):
+    # the deployments named target_tag (all deployments if it is None) as {name: {"guid", "space_id", "space_name", "scoring_url"}}
+    space_names = {space["metadata"]["id"]: space["entity"]["name"] for space in spaces}
+
+    valid_deployments = {}
+    for deployment in deployments:
+        name = deployment["entity"].get("name")
+        if target_tag is None or name == target_tag:
+            # select a unique index name for the deployment
+            index_name = name
+            i = 1
+            while index_name in valid_deployments:
+                i += 1
+                index_name = "{} ({})".format(name, i)
+
+            space_id = deployment["entity"].get("space_id")
+            valid_deployments[index_name] = {
+                "guid": deployment["metadata"]["id"],
+                "space_id": space_id,
+                "space_name": space_names.get(space_id),
+                "scoring_url": deployment["entity"].get("status", {}).get("online_url", {}).get("url")
+            }
+
+    if len(valid_deployments) == 0:
+        raise Exception("ERROR: No valid deployments found.\n"
+                        "Make sure you have Developer or Admin access to a Project Release with a deployment tagged with '{}'".format(target_tag))
+    return valid_deployments
+
+
+def parse_scoring_response(response):
+    # the response, or {"error": ...} if it has no predictions
+    if len(response.get("predictions", [])) > 0:
+        return response
+    elif "stderr" in response:
+        return {"error": response["stderr"]}
+    return {"error": response}
+
+
+class CP4DClient:
+    # one user's connection to a Cloud Pak for Data server
+
+    def __init__(self, hostname, username, password, catalog_ttl=300, timeout=TIMEOUT):
+        self.base_url = base_url(hostname)
+        self.username = username
+        self.password = password
+        self.catalog_ttl = catalog_ttl
+        self.timeout = timeout
+        self.session = new_session()
+        self._token = None
+        self._token_expires = 0
+        self._catalog = None
+        self._catalog_expires = 0
+        self._token_lock = threading.Lock()
+        self._catalog_lock = threading.Lock()
+
+    def token(self):
+        # the cached bearer token, authenticating again once it has expired
+        with self._token_lock:
+            if self._token is None or time.time() >= self._token_expires:
+                auth_response = self.session.get(self.base_url + "/v1/preauth/validateAuth", auth=(self.username, self.password),
+                                                 timeout=self.timeout).json()
+                if "accessToken" in auth_response:
+                    self._token = auth_response["accessToken"]
+                    self._token_expires = token_expiry(self._token)
+                elif "message" in auth_response:
+                    raise Exception("ERROR: " + auth_response["message"])
+                else:
+                    raise Exception("ERROR: " + str(auth_response))
+            return self._token
+
+    def reset(self):
+        # authenticate and fetch the catalog again the next time they are used
+        with self._token_lock:
+            self._token = None
+        with self._catalog_lock:
+            self._catalog = None
+
+    def _request(self, method, url, timeout=None, **kwargs):
+        token = self.token()
+        response = self.session.request(method, url, headers={"Authorization": "Bearer " + token}, timeout=timeout or self.timeout, **kwargs)
+        if response.status_code == 401:
+            # the token was revoked or expired early, authenticate again and retry once
+            with self._token_lock:
+                if self._token == token:
+                    self._token = None
+            response = self.session.request(method, url, headers={"Authorization": "Bearer " + self.token()}, timeout=timeout or self.timeout, **kwargs)
+        return response.json()
+
+    def catalog(self):
+        # the spaces and deployments, cached for catalog_ttl seconds
+        with self._catalog_lock:
+            if self._catalog is None or time.time() >= self._catalog_expires:
+                # authenticate first so that both requests use the same token
+                self.token()
+                spaces = _executor.submit(self._request, "GET", self.base_url + "/v2/spaces")
+                deployments = _executor.submit(self._request, "GET", self.base_url + "/ml/v4/deployments",
+                                               params={"version": str(datetime.date.today())})
+                self._catalog = (spaces.result()["resources"], deployments.result()["resources"])
+                self._catalog_expires = time.time() + self.catalog_ttl
+            return self._catalog
+
+    def collect_deployments(self, target_tag=None):
+        # returns {"token": token, "deployments": {name: {"guid", "space_id", "space_name", "scoring_url"}}, "client": self}
+        spaces, deployments = self.catalog()
+        return {"token": self.token(), "deployments": parse_deployments(spaces, deployments, target_tag), "client": self}
+
+    def score(self, scoring_url, payload, timeout=SCORING_TIMEOUT):
+        # score the payload ({"fields": [...], "values": [[...]]}) with the deployment
+        response = self._request("POST", scoring_url, timeout=timeout, params={"version": str(datetime.date.today())},
+                                 json={"input_data": [payload]})
+        return parse_scoring_response(response)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(hostname, username, password):
+    # the shared client for the user on the host, a new one if the password has changed
+    # a new client only replaces the shared one once it has authenticated, so a wrong password never drops a working client
+    key = (base_url(hostname), username)
+    with _clients_lock:
+        client = _clients.get(key)
+    if client is not None and client.password == password:
+        return client
+
+    client = CP4DClient(hostname, username, password)
+    client.token()
+    with _clients_lock:
+        _clients[key] = client
+    return client
+
+
+def cp4d_api_function(hostname, username, password, target_tag=None):
+    # authenticate and collect the deployments named target_tag (all deployments if it is None)
+    return get_client(hostname, username, password).collect_deployments(target_tag)
+
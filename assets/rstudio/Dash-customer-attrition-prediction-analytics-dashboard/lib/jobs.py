@@ -0,0 +1,71 @@
+# Sample Materials, provided under license.
+# Licensed Materials - Property of IBM
+# © Copyright IBM Corp. 2019, 2020. All Rights Reserved.
+# US Government Users Restricted Rights - Use, duplication or disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+
+# Background jobs for the Dash callbacks
+# A callback submits the call to the Cloud Pak for Data API as a job and returns its id at once, then a dcc.Interval
+# polls the job until it is done, so the server's request threads never wait on the network. A job submitted with the
+# same key as one that is still running, e.g. scoring the same customer with the same deployment, gets the running job's id.
+# Jobs are kept in the memory of the process that runs them
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobQueue:
+
+    def __init__(self, max_workers=8, timeout=60, keep=600):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dashboard-job")
+        # seconds after which a job that has not finished is reported as timed out
+        self.timeout = timeout
+        # seconds a finished job is kept for polling
+        self.keep = keep
+        self.jobs = {}
+        self.running = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, function, *args, **kwargs):
+        # run function(*args, **kwargs) in the background and return the job id
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            job_id = self.running.get(key)
+            if job_id is not None and not self.jobs[job_id]["future"].done() and now - self.jobs[job_id]["submitted"] < self.timeout:
+                return job_id
+
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = {"key": key, "submitted": now, "future": self.executor.submit(function, *args, **kwargs)}
+            self.running[key] = job_id
+        return job_id
+
+    def status(self, job_id):
+        # {"state": "running"}, {"state": "done", "result": ...}, {"state": "error", "error": ...},
+        # or {"state": "timeout"} / {"state": "unknown"} with an error message
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return {"state": "unknown", "error": "The request has expired, please try again."}
+
+        future = job["future"]
+        if not future.done():
+            if time.time() - job["submitted"] < self.timeout:
+                return {"state": "running"}
+            with self._lock:
+                if self.running.get(job["key"]) == job_id:
+                    del self.running[job["key"]]
+            return {"state": "timeout", "error": "The request timed out after {} seconds.".format(self.timeout)}
+
+        if future.exception() is not None:
+            return {"state": "error", "error": str(future.exception())}
+        return {"state": "done", "result": future.result()}
+
+    def _purge(self, now):
+        # forget the jobs that have had timeout + keep seconds to finish and be polled
+        for job_id, job in list(self.jobs.items()):
+            if now - job["submitted"] > self.timeout + self.keep:
+                del self.jobs[job_id]
+                if self.running.get(job["key"]) == job_id:
+                    del self.running[job["key"]]
@@ -0,0 +1,225 @@
+# Sample Materials, provided under license.
+# Licensed Materials - Property of IBM
+# © Copyright IBM Corp. 2019, 2020. All Rights Reserved.
+# US Government Users Restricted Rights - Use, duplication or disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+
+# Load Data from CSV files
+# Each file is read the first time it is used rather than when the app starts, and is indexed by the customer
+# (or account) id, so a client view looks up the rows of one customer instead of filtering the whole file
+# A file is read again when it has changed since it was read, e.g. when the data is refreshed
+
+import hashlib
+import json
+import os
+import threading
+
+import pandas as pd
+
+DATA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the files the dashboard reads and the column each of them is indexed by
+DATASETS = {
+    "customer": "CUSTOMER_ID",
+    "customer_summary": "CUSTOMER_ID",
+    "customer_history": "CUSTOMER_ID",
+    "account": "PRIMARY_CUSTOMER_ID",
+    "account_summary": "ACCOUNT_ID",
+}
+
+clients = {
+    1103: {"name": "Leo Rakes", "image": "6M.jpg", "risk": "Medium"},
+    1195: {"name": "Catalina Santos", "image": "9F.jpg", "risk": "Medium"},
+    1116: {"name": "Thomas Owens", "image": "23M.jpg", "risk": "Low"},
+    1115: {"name": "Liliana Hunnisett", "image": "10F.jpg", "risk": "Low"},
+    1114: {"name": "Jeffery Smith", "image": "5M.jpg", "risk": "Low"},
+    1021: {"name": "Jesica Abrams", "image": "22F.jpg", "risk": "Low"},
+    1049: {"name": "Carla Warnes", "image": "25F.jpg", "risk": "Medium"}
+}
+clientIds = list(clients.keys())
+
+colsToDrop = [
+    "CUSTOMER_SUMMARY_FUNDS_UNDER_MANAGEMENT_mean",
+    "CUSTOMER_SUMMARY_FUNDS_UNDER_MANAGEMENT_min",
+    "CUSTOMER_SUMMARY_FUNDS_UNDER_MANAGEMENT_max",
+    "CUSTOMER_SUMMARY_TOTAL_AMOUNT_OF_DEPOSITS_min",
+    "CUSTOMER_SUMMARY_TOTAL_AMOUNT_OF_DEPOSITS_max",
+    "CUSTOMER_SUMMARY_TOTAL_AMOUNT_OF_DEPOSITS_sum",
+    "CUSTOMER_ANNUAL_INCOME",
+    "CUSTOMER_NUMBER_OF_DEPENDENT_CHILDREN",
+    "CUSTOMER_TENURE",
+    "NUM_ACCOUNTS_WITH_RISK_TOLERANCE_MODERATE",
+    "NUM_ACCOUNTS_WITH_RISK_TOLERANCE_HIGH",
+    "NUM_ACCOUNTS_WITH_RISK_TOLERANCE_VERY_LOW",
+    "NUM_ACCOUNTS_WITH_RISK_TOLERANCE_LOW",
+    "CUSTOMER_SUMMARY_TOTAL_AMOUNT_OF_DEPOSITS_current_vs_6_months_ago",
+    "CUSTOMER_SUMMARY_TOTAL_AMOUNT_OF_DEPOSITS_max_min_ratio"
+]
+
+
+def dollar(value):
+    # format an amount like scales::dollar in R, with cents only for amounts under 100,000 that have them
+    if pd.isnull(value):
+        return ""
+    if abs(value) < 100000 and value != round(value):
+        return "${:,.2f}".format(value)
+    return "${:,.0f}".format(value)
+
+
+class Dataset:
+    # one CSV file, read on first use and indexed by its key column
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        # the frame, the positions of the rows for each key value and the version of the file they were read from,
+        # replaced together so that a reload never leaves a frame with another frame's index
+        self._loaded = None
+        self._lock = threading.Lock()
+
+    def _file_version(self):
+        # the modification time and size of the file, the same in every process that reads it
+        if not os.path.exists(self.path):
+            return "missing"
+        stat = os.stat(self.path)
+        return "{}:{}".format(stat.st_mtime_ns, stat.st_size)
+
+    def _load(self, version):
+        # callbacks run in several threads, so only one of them reads the file
+        with self._lock:
+            if self._loaded is None or self._loaded[2] != version:
+                if os.path.exists(self.path):
+                    frame = pd.read_csv(self.path)
+                else:
+                    print("Data file not found: " + self.path)
+                    frame = pd.DataFrame(columns=[self.key])
+                # positions of the rows for each key value, in file order
+                rows = {key: positions for key, positions in frame.groupby(self.key, sort=False).indices.items()}
+                self._loaded = (frame, rows, version)
+            return self._loaded
+
+    def _get_loaded(self):
+        version = self._file_version()
+        loaded = self._loaded
+        if loaded is None or loaded[2] != version:
+            loaded = self._load(version)
+        return loaded
+
+    @property
+    def frame(self):
+        return self._get_loaded()[0]
+
+    @property
+    def version(self):
+        # the version of the file now, the data is read again the next time it is used if it has changed
+        return self._file_version()
+
+    def rows(self, key_value):
+        # the rows for one key value, an empty frame if there are none
+        frame, rows, version = self._get_loaded()
+        positions = rows.get(key_value)
+        if positions is None:
+            return frame.iloc[0:0]
+        return frame.iloc[positions]
+
+    def first(self, key_value):
+        # the first row for one key value as a dictionary, None if there are none
+        rows = self.rows(key_value)
+        if len(rows) == 0:
+            return None
+        return rows.iloc[0].to_dict()
+
+
+class DashboardData:
+    # the dashboard datasets, loaded lazily
+
+    def __init__(self, data_dir=DATA_DIR):
+        self.datasets = {name: Dataset(os.path.join(data_dir, name + ".csv"), key) for name, key in DATASETS.items()}
+
+    def version(self):
+        # changes when any of the files changes, from the modification time and size of each file when it is called
+        versions = ",".join(name + "=" + dataset.version for name, dataset in self.datasets.items())
+        return hashlib.sha1(versions.encode()).hexdigest()
+
+    def __getitem__(self, name):
+        # the whole dataset, e.g. data["customer"]
+        return self.datasets[name].frame
+
+    def customer(self, customer_id):
+        return self.datasets["customer"].first(customer_id)
+
+    def customer_summary(self, customer_id):
+        return self.datasets["customer_summary"].rows(customer_id)
+
+    def customer_history(self, customer_id):
+        return self.datasets["customer_history"].rows(customer_id)
+
+    def accounts(self, customer_id):
+        return self.datasets["account"].rows(customer_id)
+
+    def account_summaries(self, account_ids):
+        account_summary = self.datasets["account_summary"]
+        frames = [account_summary.rows(account_id) for account_id in account_ids]
+        if len(frames) == 0:
+            return account_summary.frame.iloc[0:0]
+        return pd.concat(frames)
+
+    def client(self, customer_id):
+        # everything the client panel shows for a customer, None if the customer is not in customer.csv
+        selection = self.customer(customer_id)
+        if selection is None:
+            return None
+        client = dict(clients.get(customer_id, {"name": str(customer_id), "image": "", "risk": ""}))
+        client.update({
+            "id": customer_id,
+            "age_range": selection["AGE_RANGE"],
+            "marital_status": selection["MARITAL_STATUS"],
+            "address": "{}, {}".format(selection["ADDRESS_HOME_CITY"], selection["ADDRESS_HOME_STATE"]),
+            "profession": selection["PROFESSION"],
+            "education_level": selection["EDUCATION_LEVEL"],
+            "annual_income": dollar(selection["ANNUAL_INCOME"]),
+            "home_owner_indicator": selection["HOME_OWNER_INDICATOR"] == True,
+            "monthly_housing_cost": dollar(selection["MONTHLY_HOUSING_COST"]),
+            "credit_score": selection["CREDIT_SCORE"],
+            "credit_authority_level": selection["CREDIT_AUTHORITY_LEVEL"]
+        })
+
+        # the customer's first account and the first summary of their accounts, as in the R dashboard
+        accounts = self.accounts(customer_id).head(1)
+        account_summaries = self.account_summaries(accounts["ACCOUNT_ID"] if len(accounts) > 0 else [])
+        client["account"] = {col.lower(): value for col, value in accounts.iloc[0].items()} if len(accounts) > 0 else {}
+        client["account_summary"] = {}
+        if len(account_summaries) > 0:
+            for col, value in account_summaries.iloc[0].items():
+                if col.startswith("AMOUNT_") or col.endswith("_BALANCE"):
+                    value = dollar(value)
+                client["account_summary"][col.lower()] = value
+        return client
+
+
+# the home panel figures written by HomeSummary in attrition_summary.py
+HOME_SUMMARY_PATH = os.environ.get("HOME_SUMMARY_PATH", os.path.join(DATA_DIR, "home_summary.json"))
+_home_summary = (None, None)
+
+
+def load_home_summary(path=HOME_SUMMARY_PATH):
+    # the summary is only read again when the file has been rewritten, None if it has not been written yet
+    global _home_summary
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    version = (path, stat.st_mtime_ns, stat.st_size)
+    if _home_summary[0] != version:
+        with open(path) as f:
+            _home_summary = (version, json.load(f))
+    return _home_summary[1]
+
+
+_data = None
+
+
+def load_data(data_dir=DATA_DIR):
+    # the shared datasets; nothing is read until a dataset is first used
+    global _data
+    if _data is None or _data.datasets["customer"].path != os.path.join(data_dir, "customer.csv"):
+        _data = DashboardData(data_dir)
+    return _data
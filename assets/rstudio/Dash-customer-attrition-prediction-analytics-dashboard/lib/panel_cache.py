@@ -0,0 +1,86 @@
+# Sample Materials, provided under license.
+# Licensed Materials - Property of IBM
+# © Copyright IBM Corp. 2019, 2020. All Rights Reserved.
+# US Government Users Restricted Rights - Use, duplication or disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+
+# Cache of rendered panels
+# The rendered components are stored as JSON in a sqlite file so that every Dash worker process on the machine shares them.
+# The file is kept in a directory that only the user running the app can read or write, and the entries are read back as
+# the JSON that Dash sends to the browser rather than unpickled, so the cache can never run code.
+# Entries are keyed by customer id and the version of the data they were rendered from, expire after ttl seconds,
+# and the least recently used entries are evicted once there are more than max_entries
+
+import contextlib
+import json
+import os
+import sqlite3
+import stat
+import time
+
+from plotly.utils import PlotlyJSONEncoder
+
+CACHE_DIR = os.environ.get("PANEL_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "customer-attrition-dashboard"))
+
+
+def private_dir(path):
+    # create the directory for the user running the app only, and refuse to use one that belongs to someone else
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    dir_stat = os.lstat(path)
+    if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid():
+        raise PermissionError("The panel cache directory {} is not a directory owned by the user running the app".format(path))
+    if stat.S_IMODE(dir_stat.st_mode) & 0o077:
+        os.chmod(path, 0o700)
+    return path
+
+
+class PanelCache:
+
+    def __init__(self, cache_dir=CACHE_DIR, max_entries=256, ttl=600):
+        self.path = os.path.join(private_dir(cache_dir), "panel-cache.sqlite")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS panels (customer_id TEXT, version TEXT, value TEXT, created REAL, accessed REAL, "
+                         "PRIMARY KEY (customer_id, version))")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # a connection for each call, as callbacks run in several threads and processes
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, customer_id, version):
+        # the cached value as JSON data (components as the dictionaries Dash sends to the browser), None if it is not cached or has expired
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM panels WHERE customer_id = ? AND version = ? AND created > ?",
+                               (str(customer_id), version, now - self.ttl)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE panels SET accessed = ? WHERE customer_id = ? AND version = ?", (now, str(customer_id), version))
+        return json.loads(row[0])
+
+    def set(self, customer_id, version, value):
+        # entries are only removed once they expire or are the least recently used, never because another worker has a newer version of the data
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO panels VALUES (?, ?, ?, ?, ?)",
+                         (str(customer_id), version, json.dumps(value, cls=PlotlyJSONEncoder), now, now))
+            conn.execute("DELETE FROM panels WHERE created <= ?", (now - self.ttl,))
+            conn.execute("DELETE FROM panels WHERE rowid NOT IN (SELECT rowid FROM panels ORDER BY accessed DESC LIMIT ?)", (self.max_entries,))
+
+    def get_or_render(self, customer_id, version, render):
+        # the cached value, or the value of render() which is then cached
+        value = self.get(customer_id, version)
+        if value is None:
+            value = render()
+            self.set(customer_id, version, value)
+        return value
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM panels")
@@ -0,0 +1,47 @@
+# Sample Materials, provided under license.
+# Licensed Materials - Property of IBM
+# © Copyright IBM Corp. 2019, 2020. All Rights Reserved.
+# US Government Users Restricted Rights - Use, duplication or disclosure restricted by GSA ADP Schedule Contract with IBM Corp.
+
+# Server-side state of each browser session
+# The browser only holds a random session key in a dcc.Store, the API client and deployments it authenticated for are
+# kept here under that key, so one session never scores with another session's credentials.
+# Sessions that have not been used for ttl seconds are forgotten and have to authenticate again
+
+import threading
+import time
+import uuid
+
+
+class Sessions:
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_key():
+        return uuid.uuid4().hex
+
+    def set(self, key, **values):
+        # store the values of the session, e.g. set(key, client=client, deployments=deployments)
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            self.sessions[key] = {"values": values, "accessed": now}
+
+    def get(self, key):
+        # the values of the session, None if there is no session with the key or it has expired
+        now = time.time()
+        with self._lock:
+            session = self.sessions.get(key)
+            if session is None or now - session["accessed"] > self.ttl:
+                return None
+            session["accessed"] = now
+            return session["values"]
+
+    def _purge(self, now):
+        for key, session in list(self.sessions.items()):
+            if now - session["accessed"] > self.ttl:
+                del self.sessions[key]
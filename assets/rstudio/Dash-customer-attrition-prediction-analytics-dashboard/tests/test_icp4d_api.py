@@ -0,0 +1,151 @@
+# Tests of the Cloud Pak for Data API client against a local http.server stub
+
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib import icp4d_api
+
+TAG = "Customer-Attrition-Prediction-Scoring-Function-Deployment"
+CATALOG_DELAY = 0.2
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # validateAuth hands out tok-1, tok-2, ..., the catalog endpoints take CATALOG_DELAY seconds to respond,
+    # and /score rejects the tokens in server.revoked with a 401
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def record(self, path):
+        with self.server.lock:
+            self.server.calls.append(path)
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        self.record(path)
+        if path == "/v1/preauth/validateAuth":
+            if self.headers.get("Authorization") != "Basic dXNlcjpwYXNzd29yZA==":
+                self.send(401, {"message": "Invalid username or password"})
+                return
+            with self.server.lock:
+                self.server.tokens += 1
+                token = "tok-{}".format(self.server.tokens)
+            self.send(200, {"accessToken": token})
+        elif path in ("/v2/spaces", "/ml/v4/deployments"):
+            start = time.time()
+            time.sleep(CATALOG_DELAY)
+            with self.server.lock:
+                self.server.intervals.append((start, time.time()))
+            if path == "/v2/spaces":
+                self.send(200, {"resources": [{"metadata": {"id": "s1"}, "entity": {"name": "Space"}}]})
+            else:
+                url = "http://127.0.0.1:{}/score".format(self.server.server_port)
+                self.send(200, {"resources": [{"metadata": {"id": "d1"}, "entity": {
+                    "name": TAG, "space_id": "s1", "status": {"online_url": {"url": url}}}}]})
+        else:
+            self.send(404, {})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = self.path.split("?")[0]
+        self.record(path)
+        token = self.headers.get("Authorization", "")[len("Bearer "):]
+        if token in self.server.revoked:
+            self.send(401, {"message": "Token expired"})
+            return
+        self.send(200, {"predictions": [{"values": {"predictions": [{"values": [[0, [0.3, 0.7]]]}]}}]})
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.lock = threading.Lock()
+    server.calls = []
+    server.intervals = []
+    server.tokens = 0
+    server.revoked = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def hostname(server):
+    icp4d_api._clients.clear()
+    return "http://127.0.0.1:{}".format(server.server_port)
+
+
+def count(server, path):
+    with server.lock:
+        return server.calls.count(path)
+
+
+PAYLOAD = {"fields": ["CUSTOMER_ID", "sc_end_date"], "values": [[1103, "2018-09-30"]]}
+
+
+def test_token_is_reused(server, hostname):
+    client = icp4d_api.CP4DClient(hostname, "user", "password")
+    scoring_url = client.collect_deployments(TAG)["deployments"][TAG]["scoring_url"]
+    for _ in range(3):
+        assert "predictions" in client.score(scoring_url, PAYLOAD)
+    assert count(server, "/v1/preauth/validateAuth") == 1
+    assert icp4d_api.get_client(hostname, "user", "password") is icp4d_api.get_client(hostname, "user", "password")
+    assert count(server, "/v1/preauth/validateAuth") == 2
+
+
+def test_retries_once_on_401(server, hostname):
+    client = icp4d_api.CP4DClient(hostname, "user", "password")
+    scoring_url = client.collect_deployments(TAG)["deployments"][TAG]["scoring_url"]
+    server.revoked.add("tok-1")
+    assert "predictions" in client.score(scoring_url, PAYLOAD)
+    assert client.token() == "tok-2"
+    assert count(server, "/v1/preauth/validateAuth") == 2
+    assert count(server, "/score") == 2
+
+
+def test_catalog_ttl(server, hostname):
+    client = icp4d_api.CP4DClient(hostname, "user", "password", catalog_ttl=0.5)
+    first = client.catalog()
+    assert client.catalog() is first
+    assert count(server, "/v2/spaces") == 1
+    assert count(server, "/ml/v4/deployments") == 1
+    time.sleep(0.6)
+    client.catalog()
+    assert count(server, "/v2/spaces") == 2
+    assert count(server, "/ml/v4/deployments") == 2
+
+
+def test_catalog_fetched_concurrently(server, hostname):
+    client = icp4d_api.CP4DClient(hostname, "user", "password")
+    client.token()
+    start = time.time()
+    client.catalog()
+    assert time.time() - start < 2 * CATALOG_DELAY
+    (first_start, first_end), (second_start, second_end) = server.intervals
+    assert first_start < second_end and second_start < first_end
+
+
+def test_wrong_password_keeps_client(server, hostname):
+    client = icp4d_api.get_client(hostname, "user", "password")
+    with pytest.raises(Exception, match="Invalid username or password"):
+        icp4d_api.get_client(hostname, "user", "wrong")
+    assert icp4d_api.get_client(hostname, "user", "password") is client